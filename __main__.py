@@ -1,6 +1,7 @@
 from asyncio import get_event_loop
 from ona.ona import Ona
 
-loop = get_event_loop()
-loop.run_until_complete(Ona().run())
-loop.close()
+if __name__ == "__main__":  # Image workers are spawned processes, which import this module without running it
+    loop = get_event_loop()
+    loop.run_until_complete(Ona().run())
+    loop.close()
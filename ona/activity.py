@@ -0,0 +1,64 @@
+from time import monotonic
+from collections import deque
+
+
+class ChannelActivity:
+    '''A ring buffer of a channel's most recent messages. Each entry holds the time the message arrived and
+    the running attachment total before it, so the attachments in the last n messages are a single subtraction.'''
+
+    def __init__(self, size):
+        self.entries = deque(maxlen=size)   # (arrival time, attachments seen before this message) tuples
+        self.attachments = 0
+
+    def record(self, attachments):
+        self.entries.append((monotonic(), self.attachments))
+        self.attachments += attachments
+
+    def age(self, n):
+        '''Seconds since the nth most recent message arrived, or None if fewer than n have been seen.'''
+        return monotonic() - self.entries[-n][0] if 0 < n <= len(self.entries) else None
+
+    def recent_attachments(self, n):
+        '''The total attachments across the last n messages (or every message seen, if there are fewer).'''
+        if not self.entries:
+            return 0
+        return self.attachments - self.entries[-min(n, len(self.entries))][1]
+
+
+class OnaActivity:
+    '''Tracks recent messages in throttled channels from the message pipeline,
+    so throttle checks never have to fetch the channel's history.'''
+
+    def __init__(self, ona):
+        self.ona = ona
+        self.window = ona.config.activity_window    # The most messages any guild's throttle settings can count
+        self.channels = {}  # Channel ids to ChannelActivity
+
+    async def record(self, state):
+        '''A pipeline stage that runs before all others, so every message in a throttled channel is counted.'''
+        channel_id = state.message.channel.id
+        if channel_id in state.guild_doc.view("chat_throttle") or channel_id in state.guild_doc.view("image_throttle"):
+            if channel_id not in self.channels:
+                self.channels[channel_id] = ChannelActivity(self.window)
+            self.channels[channel_id].record(len(state.message.attachments))
+
+    def chat_throttled(self, channel, guild_doc):
+        '''True if the channel's last chat_throttle_messages messages all arrived within chat_throttle_seconds.'''
+        activity = self.channels.get(channel.id)
+        if not activity:
+            return False
+        age = activity.age(min(guild_doc.chat_throttle_messages, self.window))
+        return age is not None and age < guild_doc.chat_throttle_seconds
+
+    def image_throttled(self, channel, guild_doc):
+        '''True if the channel's last image_throttle_messages messages have more than image_throttle_images images.'''
+        activity = self.channels.get(channel.id)
+        if not activity:
+            return False
+        n = min(guild_doc.image_throttle_messages, self.window)
+        return activity.recent_attachments(n) > guild_doc.image_throttle_images
+
+
+def setup(ona):
+    ona.activity = OnaActivity(ona)
+    ona.pipeline.add_stage("activity", ona.activity.record, order=-10)
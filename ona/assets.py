@@ -0,0 +1,94 @@
+import os
+import asyncio
+from hashlib import blake2b
+from collections import OrderedDict
+
+
+class OnaAssetCache:
+    '''A cache for CDN assets like avatars and emotes. Asset urls include the asset's hash and size, so a url always
+    refers to the same bytes and cached copies never go stale. Assets are kept in memory up to a byte budget,
+    and optionally on disk up to a second, larger budget. Both tiers evict the least recently used assets first.'''
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        self.memory = OrderedDict()     # Asset urls to bytes
+        self.memory_bytes = memory_bytes
+        self.memory_used = 0
+        self.disk_dir = disk_dir
+        self.disk = OrderedDict()   # Filenames to file sizes, in least recently used order
+        self.disk_bytes = disk_bytes
+        self.disk_used = 0
+        self.loading = {}
+        self.hits = self.disk_hits = self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            paths = (os.path.join(disk_dir, filename) for filename in os.listdir(disk_dir))
+            for path in sorted(paths, key=os.path.getmtime):    # Files left from the last run, oldest first
+                self.disk[os.path.basename(path)] = os.path.getsize(path)
+                self.disk_used += self.disk[os.path.basename(path)]
+
+    async def read(self, asset):
+        '''Return the bytes of a discord Asset (or anything with a url and a read coroutine).
+        Concurrent reads of the same asset share one download.'''
+        url = str(asset)
+        if url in self.memory:
+            self.memory.move_to_end(url)
+            self.hits += 1
+            return self.memory[url]
+        if url not in self.loading:
+            self.loading[url] = asyncio.ensure_future(self.load(url, asset))
+            self.loading[url].add_done_callback(lambda _: self.loading.pop(url, None))
+        return await asyncio.shield(self.loading[url])
+
+    async def read_many(self, assets):
+        return await asyncio.gather(*(self.read(asset) for asset in assets))
+
+    async def load(self, url, asset):
+        loop = asyncio.get_running_loop()
+        filename = blake2b(url.encode(), digest_size=16).hexdigest()
+        data = None
+        if filename in self.disk:
+            self.disk.move_to_end(filename)
+            try:
+                data = await loop.run_in_executor(None, self.read_file, filename)
+                self.disk_hits += 1
+            except FileNotFoundError:   # Removed by someone else, so forget it and download it again
+                self.disk_used -= self.disk.pop(filename, 0)
+        if data is None:
+            self.misses += 1
+            data = await asset.read()
+            if self.disk_dir and len(data) <= self.disk_bytes:
+                # The index is only touched here on the event loop, the executor just does the file operations
+                self.disk[filename] = len(data)
+                self.disk_used += len(data)
+                evicted = []
+                while self.disk_used > self.disk_bytes:
+                    evicted.append(self.disk.popitem(last=False))
+                    self.disk_used -= evicted[-1][1]
+                await loop.run_in_executor(None, self.write_file, filename, data, [name for name, _ in evicted])
+        self.remember(url, data)
+        return data
+
+    def remember(self, url, data):
+        if len(data) > self.memory_bytes:
+            return
+        self.memory[url] = data
+        self.memory_used += len(data)
+        while self.memory_used > self.memory_bytes:
+            self.memory_used -= len(self.memory.popitem(last=False)[1])
+
+    def read_file(self, filename):
+        with open(os.path.join(self.disk_dir, filename), "rb") as file:
+            return file.read()
+
+    def write_file(self, filename, data, evicted):
+        with open(os.path.join(self.disk_dir, filename), "wb") as file:
+            file.write(data)
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {"memory": len(self.memory), "memory_bytes": self.memory_used, "disk": len(self.disk),
+                "disk_bytes": self.disk_used, "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
@@ -0,0 +1,87 @@
+import regex
+import asyncio
+from time import monotonic
+
+
+class OnaCensor:
+    '''Compiled censor matchers for each guild. All of a guild's patterns are combined into a single alternation,
+    which is only rebuilt when the guild's censored list changes. Each message is searched under one time budget
+    shared by all of the guild's matchers, so a pattern with catastrophic backtracking can't pin the event loop.'''
+
+    # Patterns are compiled on their own if they refer to groups by number or name (backreferences and recursion),
+    # which would point at the wrong groups in the alternation, or set a global inline flag like (?x) or (?s),
+    # which would change how every other pattern in the alternation matches
+    standalone = regex.compile(r"\\[1-9]|\\g<|\(\?P[=>]|\(\?&|\(\?[\w+-]+\)")
+    probe_lengths = (64, 128, 256, 512, 1024)
+    max_growth = 16     # Doubling the input may multiply the time by at most this, i.e. up to quartic time
+
+    def __init__(self, timeout, validate_timeout):
+        self.timeout = timeout
+        self.validate_timeout = validate_timeout
+        self.matchers = {}  # Guild ids to lists of compiled patterns
+
+    def invalidate(self, guild_id):
+        self.matchers.pop(guild_id, None)
+
+    def compile(self, patterns):
+        '''Compile a guild's patterns. Invalid ones (e.g. added before patterns were validated) are left out,
+        so they can't break the rest of the guild's censor.'''
+        valid = []
+        for pattern in patterns:
+            try:
+                regex.compile(pattern)
+                valid.append(pattern)
+            except regex.error as e:
+                print(f"Skipping the invalid censor pattern `{pattern}`: {e}")
+        combined = [pattern for pattern in valid if not self.standalone.search(pattern)]
+        separate = [pattern for pattern in valid if self.standalone.search(pattern)]
+        compiled = [regex.compile("|".join(f"(?:{pattern})" for pattern in combined), regex.IGNORECASE)] \
+            if combined else []
+        return compiled + [regex.compile(pattern, regex.IGNORECASE) for pattern in separate]
+
+    def search(self, guild_id, patterns, content):
+        '''Return True if the content matches any of the patterns. Searches that run out of time count as no match.'''
+        if guild_id not in self.matchers:
+            self.matchers[guild_id] = self.compile(patterns)
+        deadline = monotonic() + self.timeout
+        try:
+            for matcher in self.matchers[guild_id]:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise TimeoutError()
+                if matcher.search(content, timeout=remaining):
+                    return True
+            return False
+        except TimeoutError:
+            print(f"A censor search in guild {guild_id} ran out of time.")
+            return False
+
+    async def validate(self, pattern):
+        '''Raise ValueError if the pattern is invalid, or if it backtracks catastrophically on simple repetitive
+        inputs built from its own characters. The checks run in a thread, under one overall time budget.
+        Patterns that are merely slow (i.e. quadratic) are allowed, since search limits each message's time anyway.'''
+        try:
+            compiled = regex.compile(pattern, regex.IGNORECASE)
+        except regex.error as e:
+            raise ValueError(f"`{pattern}` is not a valid pattern: {e}.")
+        if not await asyncio.get_running_loop().run_in_executor(None, self.backtracks_safely, compiled):
+            raise ValueError(f"`{pattern}` takes too long to match and could freeze the bot.")
+
+    def backtracks_safely(self, compiled):
+        '''Time the pattern on probes of doubling length, and fail if the time grows faster than polynomially.'''
+        deadline = monotonic() + self.validate_timeout
+        for char in {*"a1 _.-", *(char for char in compiled.pattern if char.isalnum())}:
+            previous = None
+            for length in self.probe_lengths:
+                start = monotonic()
+                try:
+                    if start >= deadline:
+                        return False
+                    compiled.search(char * length + "\u2060", timeout=deadline - start, concurrent=True)
+                except TimeoutError:
+                    return False
+                elapsed = monotonic() - start
+                if previous and elapsed > 0.001 and elapsed > previous * self.max_growth:  # Shorter ones are noise
+                    return False
+                previous = max(elapsed, 0.00001)
+        return True
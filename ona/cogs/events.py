@@ -3,6 +3,8 @@ import discord
 from discord.ext import commands
 
 event = commands.Cog.listener
+# The types of messages that members send. From discord.py 1.6 on, replies have a type of their own.
+member_message_types = {discord.MessageType.default, getattr(discord.MessageType, "reply", discord.MessageType.default)}
 
 
 class Events(commands.Cog):
@@ -10,29 +12,68 @@ class Events(commands.Cog):
 
     def __init__(self, ona):
         self.ona = ona
+        self.ona.pipeline.add_stage("prefilter", self.prefilter, order=0)
+        self.ona.pipeline.add_stage("commands", self.dispatch_commands, order=100)
+
+    def cog_unload(self):
+        self.ona.pipeline.remove_stage("prefilter")
+        self.ona.pipeline.remove_stage("commands")
 
     @event()
     async def on_ready(self):
         content = "Ona has logged in."
         print(content)
+        await self.ona.quote_db.create_indexes()
+        # Quotes still stored in user documents are moved before anyone can add or browse quotes. Once they're all
+        # moved, this is a single query that finds nothing.
+        moved = await self.ona.quote_db.migrate(self.ona.user_db)
+        if moved:
+            print(f"Migrated {self.ona.plural(moved, 'quote')} out of the user documents.")
+        await self.prefetch(self.ona.guilds)
         embed = self.ona.embed(content, timestamp=True, author=self.ona.user)
         main_guild = self.ona.get_guild(self.ona.config.main_guild)
-        await main_guild.get_channel(self.ona.guild_db.get_doc(main_guild).logs).send(embed=embed)
+        await main_guild.get_channel((await self.ona.guild_db.get_doc(main_guild)).logs).send(embed=embed)
+
+    @event()
+    async def on_guild_join(self, guild):
+        await self.prefetch([guild])
+
+    @event()
+    async def on_webhooks_update(self, channel):
+        self.ona.webhook_cache.pop(channel.id, None)    # The cached webhook may be gone, look it up again when needed
+
+    async def prefetch(self, guilds):
+        '''Warm the document caches for the given guilds, and for their online members if enabled.'''
+        batch_size = self.ona.config.prefetch_batch
+        await self.ona.guild_db.prefetch(guilds, batch_size)
+        for guild in guilds:    # The guild documents are cached now, so this fills the prefix index cheaply
+            await self.ona.prefixes.get_prefix(guild)
+        if self.ona.config.prefetch_members:
+            members = (member for guild in guilds for member in guild.members
+                       if not member.bot and member.status != discord.Status.offline)
+            await self.ona.user_db.prefetch(members, batch_size)
 
     @event()
     async def on_message(self, message):
-        if message.author.bot:
-            return
-        ctx = await self.ona.process_commands(message)
+        await self.ona.pipeline.process(message)
+
+    async def prefilter(self, state):
+        if state.message.author == self.ona.user or state.message.type not in member_message_types:
+            state.done = True   # Ona's own messages and system messages never need processing
+
+    async def dispatch_commands(self, state):
+        if not state.message.author.bot and self.ona.prefixes.may_be_command(state.message):
+            await self.ona.process_commands(state.message)
 
     @event()
     async def on_message_edit(self, initial, message):
         if message.author.bot:
             return
-        await self.ona.process_commands(message)
+        if self.ona.prefixes.may_be_command(message):
+            await self.ona.process_commands(message)
         if not message.guild:     # Assume we're in a guild after this point
             return
-        logs = self.ona.guild_db.get_doc(message.guild).logs
+        logs = (await self.ona.guild_db.get_doc(message.guild)).logs
         if not logs:     # Do nothing when a guild has no logs setting specified
             return
         fields = [("Before", initial.content), ("After", message.content), ("Channel", message.channel.mention)]
@@ -45,7 +86,7 @@ class Events(commands.Cog):
             return
         if not message.guild:   # Assume we're in a guild after this point
             return
-        logs = self.ona.guild_db.get_doc(message.guild).logs
+        logs = (await self.ona.guild_db.get_doc(message.guild)).logs
         if not logs:     # Do nothing when a guild has no logs setting specified, or in a PrivateChannel
             return
         embed = self.ona.embed(message.content, title="Message was deleted", timestamp=True, author=message.author)
@@ -56,7 +97,7 @@ class Events(commands.Cog):
 
     @event()
     async def on_member_join(self, member):
-        guild_doc = self.ona.guild_db.get_doc(member.guild)
+        guild_doc = await self.ona.guild_db.get_doc(member.guild)
         general = member.guild.get_channel(guild_doc.general)
         try:
             welcome_image = await self.ona.create_welcome(member)
@@ -72,7 +113,7 @@ class Events(commands.Cog):
     async def on_member_update(self, initial, member):
         if initial.roles == member.roles:
             return
-        with self.ona.user_db.doc_context(member) as member_doc:
+        async with self.ona.user_db.doc_context(member) as member_doc:
             member_doc.roles[str(member.guild.id)] = [role.id for role in member.roles[1:]]  # First role is @everyone
 
     @event()
@@ -105,7 +146,7 @@ class Events(commands.Cog):
             print(error_text)
             embed = self.ona.embed(error_text, timestamp=True, author=self.ona.user)
             main_guild = self.ona.get_guild(self.ona.config.main_guild)
-            await (await self.ona.fetch_channel(self.ona.guild_db.get_doc(main_guild).logs)).send(embed=embed)
+            await (await self.ona.fetch_channel((await self.ona.guild_db.get_doc(main_guild)).logs)).send(embed=embed)
             return
         await ctx.clean_up(await ctx.send(f"{error_text} {self.ona.config.error}"))
 
@@ -115,7 +156,7 @@ class Events(commands.Cog):
         print(error_text)
         embed = self.ona.embed(error_text, timestamp=True, author=self.ona.user)
         main_guild = self.ona.get_guild(self.ona.config.main_guild)
-        await main_guild.get_channel(self.ona.guild_db.get_doc(main_guild).logs).send(embed=embed)
+        await main_guild.get_channel((await self.ona.guild_db.get_doc(main_guild)).logs).send(embed=embed)
 
 
 def setup(ona):
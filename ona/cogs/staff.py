@@ -1,4 +1,3 @@
-import re
 import asyncio
 import discord
 from io import BytesIO
@@ -6,6 +5,8 @@ from datetime import datetime, timedelta
 from json import loads, JSONDecodeError
 from typing import Optional
 from discord.ext import commands, tasks
+from ..censor import OnaCensor
+from ..r9k import OnaR9K
 
 
 class Staff(commands.Cog):
@@ -13,11 +14,16 @@ class Staff(commands.Cog):
 
     def __init__(self, ona):
         self.ona = ona
-        self.r9k_message_cache = []
+        self.censor_engine = OnaCensor(self.ona.config.censor_timeout, self.ona.config.censor_validate_timeout)
+        self.r9k_index = OnaR9K(self.ona.r9k_db, self.ona.config.r9k_index_size)
         self.announce_events.start()
+        self.ona.pipeline.add_stage("censor", self.chat_censor, order=10)
+        self.ona.pipeline.add_stage("r9k", self.r9k_filter, order=20)
 
     def cog_unload(self):
         self.announce_events.cancel()
+        self.ona.pipeline.remove_stage("censor")
+        self.ona.pipeline.remove_stage("r9k")
 
     @commands.command()
     @commands.has_permissions(manage_messages=True)
@@ -136,12 +142,12 @@ class Staff(commands.Cog):
         for_n_minutes = f" for {self.ona.plural(minutes, 'minute')}" if minutes else ""
         if members:
             for member in members:
-                with ctx.member_doc_ctx(member) as member_doc:
+                async with ctx.member_doc_ctx(member) as member_doc:
                     member_doc.silenced.append(ctx.guild.id)
             content = (f"{members[0].display_name if len(members) == 1 else f'{len(members)} members'} "
                        f"may no longer use commands{for_n_minutes}.")
         else:
-            with ctx.guild_doc_ctx() as guild_doc:
+            async with ctx.guild_doc_ctx() as guild_doc:
                 guild_doc.silent = True
             content = f"Silent mode is now enabled. Nobody may use commands{for_n_minutes}."
         await ctx.send(content)
@@ -151,13 +157,13 @@ class Staff(commands.Cog):
         await asyncio.sleep(minutes * 60)
         if members:
             for member in members:
-                with ctx.member_doc_ctx(member) as member_doc:
+                async with ctx.member_doc_ctx(member) as member_doc:
                     if ctx.guild.id not in member_doc.silenced:
                         continue
                     member_doc.silenced.remove(ctx.guild.id)
             content = f"The member(s) from {self.ona.plural(minutes, 'minute')} ago have been unsilenced."
         else:
-            with ctx.guild_doc_ctx() as guild_doc:
+            async with ctx.guild_doc_ctx() as guild_doc:
                 if not guild_doc.silent:    # If silent mode was disabled before now
                     return
                 guild_doc.silent = False
@@ -170,14 +176,14 @@ class Staff(commands.Cog):
         '''Disable silent mode, or unsilence any number of members.'''
         if members:
             for member in members:
-                with ctx.member_doc_ctx(member) as member_doc:
+                async with ctx.member_doc_ctx(member) as member_doc:
                     if ctx.guild.id not in member_doc.silenced:
                         continue
                     member_doc.silenced.remove(ctx.guild.id)
             content = (f"{members[0].display_name if len(members) == 1 else f'{len(members)} members'} "
                        f"may use commands again.")
         else:
-            with ctx.guild_doc_ctx() as guild_doc:
+            async with ctx.guild_doc_ctx() as guild_doc:
                 self.ona.assert_(guild_doc.silent, error="Silent mode is already disabled.")
                 guild_doc.silent = False
             content = "Silent mode has been disabled. Everyone may use commands."
@@ -216,29 +222,35 @@ class Staff(commands.Cog):
     async def r9k(self, ctx, minutes: Optional[int]):
         '''Enable or disable R9K mode in the channel.
         When enabled, R9K mode will delete long duplicate messages.'''
-        with ctx.guild_doc_ctx() as guild_doc:
-            if ctx.channel.id not in guild_doc.r9k:
+        async with ctx.guild_doc_ctx() as guild_doc:
+            enabled = ctx.channel.id not in guild_doc.r9k
+            if enabled:
                 guild_doc.r9k.append(ctx.channel.id)
-                await ctx.send(f"R9K mode has been enabled in {ctx.channel.mention}.", staff_log=True)
             else:
                 guild_doc.r9k.remove(ctx.channel.id)
-                await ctx.send(f"R9K mode has been disabled in {ctx.channel.mention}.", staff_log=True)
+        if enabled:
+            await self.r9k_index.seed(ctx.channel, self.ona.config.min_r9k_char)
+            await ctx.send(f"R9K mode has been enabled in {ctx.channel.mention}.", staff_log=True)
+        else:
+            await ctx.send(f"R9K mode has been disabled in {ctx.channel.mention}.", staff_log=True)
+        if not enabled or not minutes:
+            return
         await asyncio.sleep(minutes * 60)
-        with ctx.guild_doc_ctx() as guild_doc:
+        async with ctx.guild_doc_ctx() as guild_doc:
             if ctx.channel.id in guild_doc.r9k:
                 guild_doc.r9k.remove(ctx.channel.id)
                 await ctx.send(f"R9K mode has been disabled in {ctx.channel.mention}.", staff_log=True)
 
-    @commands.Cog.listener(name="on_message")
-    async def r9k_listener(self, message):
-        if message.channel.id not in self.ona.guild_db.get_doc(message.guild).r9k:
+    async def r9k_filter(self, state):
+        message = state.message
+        if message.channel.id not in state.guild_doc.view("r9k"):
             return
-        if message.channel.permissions_for(message.author).administrator or message.author.bot:
+        if message.author.bot or state.permissions.administrator:
             return
         if len(message.content) < self.ona.config.min_r9k_char:
             return
-        if await message.channel.history(before=message).get(content=message.content):
-            await message.delete()
+        if await self.r9k_index.is_duplicate(message.channel, message.content):
+            await state.delete()
 
     @commands.command(aliases=["add_emote"])
     @commands.has_permissions(manage_emojis=True)
@@ -246,7 +258,8 @@ class Staff(commands.Cog):
     async def addemote(self, ctx, name=None):
         '''Create an emote in the server with the specified name.'''
         name = name or (await ctx.ask("Give a name for the emote:")).replace(" ", "_")
-        image = await self.ona.request(await ctx.get_last_url())
+        # Discord rejects emotes over 256 KB, so there's no point downloading anything larger
+        image = await self.ona.request_image(await ctx.get_last_url(), max_bytes=256 * 1024)
         try:
             emote = await ctx.guild.create_custom_emoji(name=name, image=image)
         except discord.HTTPException as e:
@@ -268,23 +281,32 @@ class Staff(commands.Cog):
         setting = setting or await ctx.ask("Which setting would you like to edit?")
         self.ona.assert_(setting in self.ona.guild_db.template,
                          error=f"That isn't a valid setting. Use `{ctx.guild_doc.prefix}settings` to see all settings.")
-        with ctx.guild_doc_ctx() as guild_doc:
+        async with ctx.guild_doc_ctx() as guild_doc:
             content = f"Give the new value for `{setting}`:"
             if setting in guild_doc:
                 content = f"`{setting}` is currently set to `{guild_doc[setting]}`. {content}"
             new_setting = value if value else await ctx.ask(content)
             try:
-                guild_doc[setting] = loads(new_setting)
+                new_setting = loads(new_setting)
             except JSONDecodeError:
-                guild_doc[setting] = new_setting
+                pass
+            if setting == "censored":   # Patterns are checked the same way the censor command checks them
+                self.ona.assert_(isinstance(new_setting, list) and all(isinstance(p, str) for p in new_setting),
+                                 error="`censored` must be a list of patterns, like `[\"pattern\", \"pattern\"]`.")
+                await self.validate_censored(new_setting)
+            guild_doc[setting] = new_setting
+        if setting == "prefix":
+            self.ona.prefixes[ctx.guild.id] = guild_doc.prefix
+        elif setting == "censored":
+            self.censor_engine.invalidate(ctx.guild.id)
         await ctx.send(f"`{setting}` is now set to `{ctx.guild_doc[setting]}`.", staff_log=True)
 
     @commands.command()
     @commands.has_permissions(manage_roles=True)
     async def unquote(self, ctx, member: discord.Member, number: int):
         '''Remove a quote from a member.'''
-        with ctx.member_doc_ctx(member) as member_doc:
-            member_doc.quotes.pop(number - 1)
+        self.ona.assert_(await self.ona.quote_db.remove_quote(member, number),
+                         error=f"{member.display_name} doesn't have a {self.ona.ordinal(number)} quote.")
         await ctx.send(f"{member.display_name}'s {self.ona.ordinal(number)} quote has been removed.", staff_log=True)
 
     @commands.command(aliases=["give_perm"])
@@ -292,7 +314,7 @@ class Staff(commands.Cog):
     async def giveperm(self, ctx, member: discord.Member, perm=None):
         '''Give a member a role with a designated permission.'''
         perm = perm.lower() or (await ctx.ask(f"Give a permission for {member.display_name}:")).lower()
-        with ctx.guild_doc_ctx() as guild_doc:
+        async with ctx.guild_doc_ctx() as guild_doc:
             role_id = guild_doc[perm]
             self.ona.assert_(role_id, error=f"The {perm.title()} role has not been assigned.")
             role = ctx.guild.get_role(role_id)
@@ -305,7 +327,7 @@ class Staff(commands.Cog):
     async def removeperm(self, ctx, member: discord.Member, perm=None):
         '''Remove a permission from a member.'''
         perm = perm.lower() or (await ctx.ask(f"Give a permission to take from {member.display_name}:")).lower()
-        with ctx.guild_doc_ctx() as guild_doc:
+        async with ctx.guild_doc_ctx() as guild_doc:
             role_id = guild_doc[perm]
             self.ona.assert_(role_id, error=f"The {perm.title()} role has not been assigned.")
             role = ctx.guild.get_role(role_id)
@@ -336,9 +358,16 @@ class Staff(commands.Cog):
     @commands.is_owner()
     async def editavatar(self, ctx):
         '''Change Ona's avatar.'''
-        await self.ona.user.edit(avatar=await self.ona.request(await ctx.get_last_url()))
+        await self.ona.user.edit(avatar=await self.ona.request_image(await ctx.get_last_url()))
         await ctx.send("My avatar has been updated.", staff_log=True)
 
+    @commands.command(aliases=["migrate_quotes"])
+    @commands.is_owner()
+    async def migratequotes(self, ctx):
+        '''Move quotes stored in user documents into the quotes collection.'''
+        moved = await self.ona.quote_db.migrate(self.ona.user_db)
+        await ctx.send(f"{self.ona.plural(moved, 'quote')} moved into the quotes collection.")
+
     @commands.command(name="eval")
     @commands.is_owner()
     async def _eval(self, ctx, *, expression):
@@ -348,11 +377,61 @@ class Staff(commands.Cog):
         except Exception as e:
             raise self.ona.OnaError(f"{type(e).__name__}: {e}")
 
+    @commands.command(aliases=["db_stats", "cachestats", "cache_stats"])
+    @commands.is_owner()
+    async def dbstats(self, ctx):
+        '''View hit, miss, eviction and load latency counters for each document cache.'''
+        fields = []
+        for db in self.ona.dbs:
+            stats = db.doc_cache.stats()
+            ttl = self.ona.plural(stats["ttl"], "second") if stats["ttl"] else "none"
+            fields.append((db.collection.name.title(),
+                           f"Size: {stats['size']:,} / {stats['maxsize']:,} (TTL: {ttl})\n"
+                           f"Hits: {stats['hits']:,} ({stats['hit_rate']:.1%})\nMisses: {stats['misses']:,}\n"
+                           f"Evictions: {stats['evictions']:,}\nExpirations: {stats['expirations']:,}\n"
+                           f"Loads: {stats['loads']:,} (avg {stats['avg_load_ms']:.2f} ms)"))
+        await ctx.send(embed=self.ona.embed(title="Document Caches", timestamp=True, fields=fields))
+
+    @commands.command(aliases=["pipeline_stats"])
+    @commands.is_owner()
+    async def pipelinestats(self, ctx):
+        '''View timing counters for each stage of the message pipeline.'''
+        fields = []
+        for order, name, _ in self.ona.pipeline.stages:
+            timer = self.ona.pipeline.timers[name]
+            average = timer.total / timer.calls * 1000 if timer.calls else 0
+            fields.append((f"{order}) {name}",
+                           f"Calls: {timer.calls:,}\nAvg: {average:.3f} ms\nMax: {timer.max * 1000:.3f} ms"))
+        await ctx.send(embed=self.ona.embed(title="Message Pipeline", timestamp=True, fields=fields))
+
+    @commands.command(aliases=["image_stats"])
+    @commands.is_owner()
+    async def imagestats(self, ctx):
+        '''View the queue depth and job timings of the image engine.'''
+        stats = self.ona.images.stats()
+        fields = [("Queue", f"Waiting: {stats['waiting']}\nRunning: {stats['running']}"),
+                  ("Jobs", f"Completed: {stats['completed']:,}\nFailed: {stats['failed']:,}\n"
+                           f"Avg: {stats['avg_ms']:.1f} ms\nMax: {stats['max_ms']:.1f} ms"),
+                  ("Pool", f"Restarts: {stats['restarts']:,}")]
+        await ctx.send(embed=self.ona.embed(title="Image Engine", timestamp=True, fields=fields))
+
+    @commands.command(aliases=["web_stats"])
+    @commands.is_owner()
+    async def webstats(self, ctx):
+        '''View latency and failures for each host Ona makes requests to.'''
+        fields = []
+        for host, health in list(self.ona.web.stats().items())[:25]:   # Embeds are limited to 25 fields
+            latency = f"{health.latency * 1000:.0f} ms" if health.latency is not None else "N/A"
+            fields.append((f"{host} ({'open' if health.open else 'closed'})",
+                           f"Requests: {health.requests:,}\nFailures: {health.failures:,}\nAvg: {latency}\n"
+                           f"Max: {health.max_latency * 1000:.0f} ms"))
+        await ctx.send(embed=self.ona.embed(title="Web Hosts", timestamp=True, fields=fields))
+
     @commands.command(aliases=["edit_money"])
     @commands.is_owner()
     async def editmoney(self, ctx, member: discord.Member, money: int):
         '''Give or remove money from a user.'''
-        with ctx.member_doc_ctx(member) as member_doc:
+        async with ctx.member_doc_ctx(member) as member_doc:
             member_doc.money += money
         content = f"{member.display_name} {'gained' if money >= 0 else 'lost'} {abs(money)} {ctx.guild_doc.currency}."
         await ctx.send(content, staff_log=True)
@@ -363,8 +442,10 @@ class Staff(commands.Cog):
     async def censor(self, ctx, *, pattern):
         '''Censor a regex pattern from the guild.'''
         pattern = pattern or await ctx.ask("Give a regex pattern to censor with:")
-        with ctx.guild_doc_ctx() as guild_doc:
+        await self.validate_censored([pattern])
+        async with ctx.guild_doc_ctx() as guild_doc:
             guild_doc.censored.append(pattern)
+        self.censor_engine.invalidate(ctx.guild.id)
         content = f"Messages with `{pattern}` will now be censored."
         await ctx.send(content)
         await ctx.staff_log(content)
@@ -375,8 +456,9 @@ class Staff(commands.Cog):
         '''Uncensor a regex pattern from the guild.'''
         pattern = pattern or await ctx.ask("Give a regex pattern to remove:")
         self.ona.assert_(pattern in ctx.guild_doc.censored, error=f"`{pattern}` is not a censored pattern.")
-        with ctx.guild_doc_ctx() as guild_doc:
+        async with ctx.guild_doc_ctx() as guild_doc:
             guild_doc.censored.remove(pattern)
+        self.censor_engine.invalidate(ctx.guild.id)
         content = f"Messages with `{pattern}` will no longer be censored."
         await ctx.send(content)
         await ctx.staff_log(content)
@@ -389,15 +471,18 @@ class Staff(commands.Cog):
         censored_list = "__**CENSORED:**__\n\n▫ `" + "`\n▫ `".join(ctx.guild_doc.censored) + "`"
         await ctx.send(censored_list)
 
-    @commands.Cog.listener(name="on_message")
-    async def chat_censor(self, message):
-        if message.guild and not message.guild.me.permissions_in(message.channel).manage_messages:
+    async def validate_censored(self, patterns):
+        for pattern in patterns:
+            try:
+                await self.censor_engine.validate(pattern)
+            except ValueError as e:
+                raise self.ona.OnaError(str(e))
+
+    async def chat_censor(self, state):
+        if not state.message.guild or not state.guild_doc.censored or not state.my_permissions.manage_messages:
             return
-        for pattern in self.ona.guild_db.get_doc(message.guild).censored:
-            if re.search(pattern, message.content, re.IGNORECASE):
-                self.ona.staff_deleted.append(message.id)
-                await message.delete()
-                return
+        if self.censor_engine.search(state.message.guild.id, state.guild_doc.censored, state.message.content):
+            await state.delete()
 
     @commands.command(aliases=["event"])
     async def schedule(self, ctx, *, description=""):
@@ -409,7 +494,7 @@ class Staff(commands.Cog):
         month, day = date.split("/")
         self.ona.assert_(month.isdigit(), day.isdigit(), error="Invalid date format.")
         self.ona.assert_(0 < int(month) <= 12, 0 < int(day) <= 31, error="Invalid date.")
-        with ctx.guild_doc_ctx() as guild_doc:
+        async with ctx.guild_doc_ctx() as guild_doc:
             guild_doc.events.append({"month": int(month), "day": int(day), "description": description})
         content = f"`{description}` has been scheduled for {month}/{day}."
         await ctx.send(content)
@@ -418,7 +503,7 @@ class Staff(commands.Cog):
     @tasks.loop(minutes=30)
     async def announce_events(self):
         now = datetime.utcnow()
-        with self.ona.guild_db.doc_context(self.ona.get_guild(self.ona.config.main_guild)) as guild_doc:
+        async with self.ona.guild_db.doc_context(self.ona.get_guild(self.ona.config.main_guild)) as guild_doc:
             if not guild_doc.announcements:
                 return
             for event in list(guild_doc.events):
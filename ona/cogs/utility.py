@@ -93,7 +93,7 @@ class Utility(commands.Cog):
     async def editbio(self, ctx):
         '''Save a bio of yourself to your profile.'''
         questions = self.ona.config.questions
-        with ctx.author_doc_ctx() as author_doc:
+        async with ctx.author_doc_ctx() as author_doc:
             if author_doc.bio:
                 content = ("You already have a bio saved. When editing your bio, type 'same' to use the same response "
                            "as the last time you edited your bio. Would you like to edit your bio now?")
@@ -122,7 +122,7 @@ class Utility(commands.Cog):
     async def bio(self, ctx, member: discord.Member = None):
         '''See another member's bio if they've made one with the editbio command.'''
         member = member or ctx.author
-        bio = defaultdict(str, self.ona.user_db.get_doc(member).bio)
+        bio = defaultdict(str, (await self.ona.user_db.get_doc(member)).bio)
         self.ona.assert_(bio, error="This user has yet to add a bio.")
         fields = [("Age", bio["age"]), ("Birthday", bio["birthday"]), ("Nationality", bio["nationality"]),
                   ("Gender", bio["gender"]), ("Sexuality", bio["sexuality"]), ("Favorite TV Shows", bio["tv_shows"]),
@@ -245,10 +245,11 @@ class Utility(commands.Cog):
         search_url = "https://od-api.oxforddictionaries.com/api/v1/search/en"
         headers = {"app_id": self.ona.secrets.oxford_id, "app_key": self.ona.secrets.oxford_key}
         params = {"q": query, "limit": 1}
-        results = (await self.ona.request(search_url, params=params, headers=headers))["results"]
+        results = (await self.ona.request(search_url, params=params, headers=headers, cache="oxford"))["results"]
         self.ona.assert_(len(results), error=f"'{query}' is not an English word.")
         entry_url = "https://od-api.oxforddictionaries.com/api/v1/entries/en/" + results[0]["id"].lower()
-        lex_entries = (await self.ona.request(entry_url, headers=headers))["results"][0]["lexicalEntries"]
+        entry = await self.ona.request(entry_url, headers=headers, cache="oxford")
+        lex_entries = entry["results"][0]["lexicalEntries"]
 
         def combine_defs(lex_entry):    # flatten each lexical entry into a list of definitions
             senses = (sense for entry in lex_entry["entries"] for sense in entry["senses"] if "definitions" in sense)
@@ -267,7 +268,8 @@ class Utility(commands.Cog):
     async def urban(self, ctx, *, query=""):
         '''Find the urban dictionary entry for a word or phrase.'''
         query = query or await ctx.ask("Give a word or phrase to search for:")
-        results = (await self.ona.request(f"https://api.urbandictionary.com/v0/define?term={query}"))["list"]
+        results = (await self.ona.request("https://api.urbandictionary.com/v0/define", params={"term": query},
+                                          cache="urban"))["list"]
         embeds = []
 
         def strip(s):
@@ -286,8 +288,8 @@ class Utility(commands.Cog):
         username = username or await ctx.ask("Give a username to search for:")
         mode = await ctx.ask("Choose a gamemode:", ["Standard", "Taiko", "Catch the Beat", "Mania"])
         params = {"k": self.ona.secrets.osu_key, "u": username, "m": mode}
-        result = self.ona.request("https://osu.ppy.sh/api/get_user", params=params)
-        self.ona.assert_(result.text != [], error="The username/id provided is invalid.")
+        result = await self.ona.request("https://osu.ppy.sh/api/get_user", params=params, cache="osu")
+        self.ona.assert_(result, error="The username/id provided is invalid.")
 
         # All stats are provided as strings by default. Convert to python objects.
         osu_user = {k: loads(v) if str(v).replace(".", "").isdigit() else v
@@ -5,6 +5,19 @@ from io import BytesIO
 from discord.ext import commands
 
 
+class CheckSnapshot:
+    '''Everything the global checks need to know about the guild and author, gathered once per invocation.'''
+
+    def __init__(self, ctx):
+        guild_doc, author_doc = ctx.guild_doc, ctx.author_doc
+        self.manage_messages = ctx.channel.permissions_for(ctx.author).manage_messages
+        self.blacklisted = ctx.channel.id in guild_doc.view("blacklist")
+        self.chat_throttled = ctx.channel.id in guild_doc.view("chat_throttle")
+        self.image_throttled = ctx.channel.id in guild_doc.view("image_throttle")
+        self.silenced = bool(ctx.guild) and ctx.guild.id in author_doc.view("silenced")
+        self.silent = bool(ctx.guild) and guild_doc.silent
+
+
 class OnaContext(commands.Context):
     '''Custom Context class with some quality of life attributes.'''
 
@@ -12,16 +25,23 @@ class OnaContext(commands.Context):
     def ona(self):
         return self.bot
 
+    async def load_docs(self):
+        '''Fetch the guild and author documents before the command is invoked, so that reading them
+        from checks and commands never has to wait on the database.'''
+        self._guild_doc = await self.ona.guild_db.get_doc(self.guild)
+        self._author_doc = await self.ona.user_db.get_doc(self.author)
+        self.check_snapshot = CheckSnapshot(self)
+
     # These doc properties are for reading purposes only. Use the doc_ctx methods for writing edits.
     @property
     def guild_doc(self):
-        return self.ona.guild_db.get_doc(self.guild)
+        return self._guild_doc
 
     @property
     def author_doc(self):
-        return self.ona.user_db.get_doc(self.author)
+        return self._author_doc
 
-    # These context managers yield OnaDocument objects, and changes to the objects update the db on exit.
+    # These async context managers yield OnaDocument objects, and changes to the objects update the db on exit.
     def guild_doc_ctx(self):
         return self.ona.guild_db.doc_context(self.guild)
 
@@ -35,7 +55,8 @@ class OnaContext(commands.Context):
         '''This custom send method adds the ability to send messages larger than the
         Discord character limit as well as the ability to specify an asset as the attachment.'''
         if asset:
-            kwargs["file"] = discord.File(BytesIO(await asset.read()), self.ona.filename_from_url(str(asset)))
+            kwargs["file"] = discord.File(BytesIO(await self.ona.assets.read(asset)),
+                                          self.ona.filename_from_url(str(asset)))
         content = self.ona.sanitize(str(content))
         if staff_log:
             await self.staff_log(content)
@@ -87,13 +108,18 @@ class OnaContext(commands.Context):
             return int(response.content) - 1    # The returned value is an index of the options list
         return response.content     # No options were provided
 
-    async def embed_browser(self, embeds, pos=0):
+    async def embed_browser(self, embeds, pos=0, *, count=None):
         '''Send a list of embeds to display each one along with reaction based controls to navigate through
-        them. The pos parameter decides which embed should be shown first.'''
+        them. The pos parameter decides which embed should be shown first.
+        Instead of a list, embeds may be a coroutine function that builds the embed at a given position on demand,
+        in which case count gives the total number of pages.'''
         can_remove_reacts = self.guild and self.channel.permissions_for(self.me).manage_messages
-        for i, embed in enumerate(embeds, 1):   # Add page numbers to each embed
-            embed.set_footer(text=f"Page {i} of {len(embeds)}")
-        message = await self.send(embed=embeds[pos])
+        count = count if callable(embeds) else len(embeds)
+
+        async def get_page(pos):    # Add the page number to each embed as it's shown
+            embed = await embeds(pos) if callable(embeds) else embeds[pos]
+            return embed.set_footer(text=f"Page {pos + 1} of {count}")
+        message = await self.send(embed=await get_page(pos))
         await message.add_reaction("⬅")
         await message.add_reaction("➡")
 
@@ -108,9 +134,9 @@ class OnaContext(commands.Context):
             if can_remove_reacts:
                 await reaction.remove(self.author)
             # Increment or decrement the position according to the reaction, unless at either end of the list
-            pos += 1 if reaction.emoji == "➡" and pos < len(embeds) - 1 else 0
+            pos += 1 if reaction.emoji == "➡" and pos < count - 1 else 0
             pos -= 1 if reaction.emoji == "⬅" and pos > 0 else 0
-            await message.edit(embed=embeds[pos])
+            await message.edit(embed=await get_page(pos))
         if can_remove_reacts:
             await message.clear_reactions()
         return message
@@ -153,8 +179,9 @@ class OnaContext(commands.Context):
         embed = self.ona.embed(content, title="Staff Logger", timestamp=True, fields=fields)
         author_name = self.author.display_name
         username = f"Action from {author_name if len(author_name) <= 20 else author_name[:17] + '...'}"
-        await self.ona.send_webhook(self.guild.get_channel(staff_logs), username=username,
-                                    avatar_url=self.author.avatar_url, embed=embed)
+        # Logs are queued and sent in batches, so this returns as soon as there's room in the guild's queue
+        await self.ona.staff_logs.log(self.guild.get_channel(staff_logs), embed, username=username,
+                                      avatar_url=self.author.avatar_url)
 
     async def get_last_url(self, count=1):
         '''For commands that require one or more images, first check if the user attached or linked a image.
@@ -1,53 +1,448 @@
-from pymongo import MongoClient, ReturnDocument
+import asyncio
+from uuid import uuid4
+from time import monotonic, perf_counter
+from copy import deepcopy
+from pymongo import ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from .storage import MongoStorage, MemoryStorage, UpdateRequest, apply_update
 from cachetools import LRUCache
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
+
+
+class WriteConflict(Exception):
+    pass
 
 
 class OnaDocument(dict):
-    '''This class represents a generic MongoDB document.'''
+    '''This class represents a generic MongoDB document.
+    It remembers the state it was last synced with, so only the fields that changed are written back.'''
 
     __getattr__ = dict.get
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        object.__setattr__(self, "_views", {})  # Bypass the dict keys
+        self.mark_synced()
+
+    def view(self, key):
+        '''A frozenset of a list field, for fast membership tests. It's cached until the document is next written.'''
+        if key not in self._views:
+            self._views[key] = frozenset(self.get(key) or ())
+        return self._views[key]
+
+    def snapshot(self):
+        return deepcopy(dict(self))
+
+    def mark_synced(self, state=None):
+        state = self.snapshot() if state is None else state
+        if "_version" in state:
+            dict.__setitem__(self, "_version", state["_version"])
+        object.__setattr__(self, "_synced", state)  # Bypass the dict keys
+
+    def prepare_write(self):
+        '''Return the filter, update and resulting synced state for a conditional write of the changes.
+        The filter only matches the version this document was last synced with, and the update bumps it.'''
+        update, state = self.delta(), self.snapshot()   # Taken together, before any other coroutine can edit the doc
+        if not update:
+            return None, None, state
+        version = self._synced.get("_version")  # Documents written before versioning have none, which matches null
+        # Versions are unique tokens rather than counters, so finding ours in the database proves our write landed
+        update.setdefault("$set", {})["_version"] = state["_version"] = uuid4().hex
+        return {"_id": self["_id"], "_version": version}, update, state
+
+    def rebase(self, fresh):
+        '''Replay the unsynced changes on top of a newer version of the document from the database,
+        so changes made elsewhere in the meantime are merged instead of overwritten.
+        The merge happens in place: nested dicts and lists are updated rather than replaced, so a coroutine that
+        held on to one of them across an await still sees the document's current contents.'''
+        merged = deepcopy(fresh)
+        apply_update(merged, self.delta())
+        self._views.clear()
+        merge_into(self, merged)
+        self.mark_synced(deepcopy(fresh))
+
+    def delta(self):
+        '''Compare the document to its last synced state and return the smallest update that applies the
+        changes, using $inc for numbers, $push/$pull for appended or removed list items and dotted $set/$unset
+        paths for nested dicts. Whole values are only $set when nothing more specific applies.'''
+        update = {}
+        diff(self._synced, self, "", update)
+        return update
+
+
+def diff(old, new, prefix, update):
+    '''Recursively collect the update operators that turn the old dict into the new dict.'''
+    for key in old.keys() - new.keys():
+        update.setdefault("$unset", {})[f"{prefix}{key}"] = ""
+    for key, value in new.items():
+        path = f"{prefix}{key}"
+        if key not in old:
+            update.setdefault("$set", {})[path] = value
+            continue
+        previous = old[key]
+        if type(previous) is type(value) and previous == value:
+            continue
+        if isinstance(previous, dict) and isinstance(value, dict) and all(dotted_key(k) for k in {*previous, *value}):
+            diff(previous, value, f"{path}.", update)
+        elif isinstance(previous, list) and isinstance(value, list):
+            removed = [item for item in previous if item not in value]
+            if value[:len(previous)] == previous:   # Items were only appended
+                update.setdefault("$push", {})[path] = {"$each": value[len(previous):]}
+            elif [item for item in previous if item not in removed] == value:   # Items were only removed
+                update.setdefault("$pull", {})[path] = {"$in": removed}
+            else:
+                update.setdefault("$set", {})[path] = value
+        elif number(previous) and number(value):
+            update.setdefault("$inc", {})[path] = value - previous
+        else:
+            update.setdefault("$set", {})[path] = value
+
+
+def merge_into(target, source):
+    '''Make the target dict equal to the source dict, keeping the target's existing dicts and lists.'''
+    for key in target.keys() - source.keys():
+        dict.__delitem__(target, key)
+    for key, value in source.items():
+        current = target.get(key)
+        if type(current) is dict and type(value) is dict:
+            merge_into(current, value)
+        elif type(current) is list and type(value) is list:
+            current[:] = value
+        else:
+            dict.__setitem__(target, key, value)
+
+
+def dotted_key(key):    # Only these keys can be addressed with a dotted path
+    return isinstance(key, str) and key and "." not in key and not key.startswith("$")
+
+
+def number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class OnaCache(LRUCache):
+    '''An LRU document cache with optional expiry that counts how well it fits the working set.'''
+
+    def __init__(self, maxsize, ttl=None):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.cached_at = {}
+        self.hits = self.misses = self.evictions = self.expirations = self.loads = 0
+        self.load_time = 0.0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.cached_at[key] = monotonic()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self.cached_at[key]
+
+    def popitem(self):  # Only called by the LRU when the cache is full
+        self.evictions += 1
+        return super().popitem()
+
+    def lookup(self, key):
+        '''Return the cached document, or None if it is missing or has expired.'''
+        if key in self and self.ttl and monotonic() - self.cached_at[key] > self.ttl:
+            del self[key]
+            self.expirations += 1
+        if key in self:
+            self.hits += 1
+            return self[key]
+        self.misses += 1
+        return None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions, "expirations": self.expirations, "loads": self.loads,
+                "avg_load_ms": self.load_time / self.loads * 1000 if self.loads else 0.0}
+
 
 class OnaDB:
-    '''Database interactions are handled here.'''
+    '''Database interactions are handled here. Every method that touches MongoDB is a coroutine,
+    so database I/O never blocks the event loop.
+    In write-behind mode, edited documents are buffered and written in batches at most flush_interval
+    seconds later (or as soon as flush_size documents are waiting) instead of one write per edit.
+    Writes are conditional on the document's _version. When a document was changed elsewhere since it was
+    loaded, the newer version is fetched, the local changes are replayed on top of it and the write is retried.'''
 
-    def __init__(self, host, port, db, collection, template, db_cache_size):
-        self.client = MongoClient(host, port)
-        self.collection = self.client[db][collection]
+    def __init__(self, collection, template, cache_size,
+                 *, cache_ttl=None, write_behind=False, flush_interval=5, flush_size=100, max_retries=5):
+        self.collection = collection
         self.template = template
-        self.doc_cache = LRUCache(db_cache_size)
+        self.doc_cache = OnaCache(cache_size, cache_ttl)
+        self.loading = {}   # In-flight loads by _id, so concurrent misses share a single query
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.dirty = {}     # Buffered documents by _id, so several edits to one document collapse into one write
+        self.flush_task = None
+        self.max_retries = max_retries
 
-    def get_doc(self, snowflake):
+    async def get_doc(self, snowflake):
         # Default to 0 if the snowflake doesn't exist (i.e. ctx.guild in a PrivateChannel)
         _id = snowflake.id if hasattr(snowflake, "id") else 0
-        if _id in self.doc_cache:
-            doc = self.doc_cache[_id]
-        else:
-            doc = OnaDocument(self.collection.find_one_and_update({"_id": _id}, {"$setOnInsert": self.template},
-                                                                  upsert=True, return_document=ReturnDocument.AFTER))
-            self.doc_cache[_id] = doc
+        doc = self.doc_cache.lookup(_id)
+        if doc is not None:
+            return doc
+        if _id in self.dirty:   # Evicted from the cache before its changes were flushed
+            doc = self.doc_cache[_id] = self.dirty[_id]
+            return doc
+        if _id not in self.loading:
+            self.loading[_id] = asyncio.ensure_future(self.load_doc(_id))
+            self.loading[_id].add_done_callback(lambda _: self.loading.pop(_id, None))
+        return await asyncio.shield(self.loading[_id])
+
+    async def load_doc(self, _id):
+        start = perf_counter()
+        doc = OnaDocument(await self.collection.find_one_and_update({"_id": _id}, {"$setOnInsert": self.template},
+                                                                    upsert=True, return_document=ReturnDocument.AFTER))
+        # Documents are validated against the template once, when they enter the cache
         if not doc.keys() >= self.template.keys():   # Basically, "the doc does not have every key in the template"
-            [doc.setdefault(key, value) for key, value in self.template.items()]    # Fill up missing keys
-            self.update_doc(doc)
+            [doc.setdefault(key, deepcopy(value)) for key, value in self.template.items()]  # Fill up missing keys
+            await self.update_doc(doc)
+        self.doc_cache[_id] = doc
+        self.doc_cache.loads += 1
+        self.doc_cache.load_time += perf_counter() - start
         return doc
 
-    def update_doc(self, doc):  # This method should not be called outside OnaDB, use doc_context instead
-        if not self.collection.replace_one({"_id": doc["_id"]}, doc).matched_count:
-            self.collection.insert_one({"_id": doc["_id"]})
+    async def prefetch(self, snowflakes, batch_size=500):
+        '''Warm the cache with many documents using batched $in queries. Documents that don't exist yet are
+        created from the template and incomplete ones are filled in, all in a single bulk_write. Those are only
+        cached once the write has succeeded.'''
+        ids = [_id for _id in dict.fromkeys(snowflake.id for snowflake in snowflakes)
+               if _id not in self.doc_cache and _id not in self.dirty and _id not in self.loading]
+        ids = ids[:self.doc_cache.maxsize]
+        unwritten = []  # (document, update) pairs for documents that need filling in
+        for i in range(0, len(ids), batch_size):
+            batch, start = ids[i:i + batch_size], perf_counter()
+            found = {doc["_id"]: doc async for doc in self.collection.find({"_id": {"$in": batch}})}
+            self.doc_cache.loads += 1
+            self.doc_cache.load_time += perf_counter() - start
+            for _id in batch:
+                if _id in self.doc_cache or _id in self.loading:    # get_doc got to it while this batch was fetched
+                    continue
+                doc = OnaDocument(found.get(_id, {"_id": _id}))
+                if doc.keys() >= self.template.keys():
+                    self.doc_cache[_id] = doc
+                    continue
+                [doc.setdefault(key, deepcopy(value)) for key, value in self.template.items()]
+                unwritten.append((doc, doc.delta()))
+        if not unwritten:
+            return
+        await self.collection.bulk_write([UpdateRequest({"_id": doc["_id"]}, update, upsert=True)
+                                          for doc, update in unwritten], ordered=False)
+        for doc, _ in unwritten:
+            if doc["_id"] not in self.doc_cache and doc["_id"] not in self.loading:
+                doc.mark_synced()
+                self.doc_cache[doc["_id"]] = doc
+
+    async def update_doc(self, doc):    # This method should not be called outside OnaDB, use doc_context instead
+        doc._views.clear()  # Even if the write itself is buffered, the views must reflect the edit right away
+        if self.write_behind:
+            self.dirty[doc["_id"]] = doc
+            if len(self.dirty) >= self.flush_size:
+                await self.flush()
+            elif not self.flush_task:
+                self.flush_task = asyncio.create_task(self.flush_later())
+            return
+        for _ in range(self.max_retries):
+            filter, update, state = doc.prepare_write()
+            if not update:
+                return
+            if (await self.collection.update_one(filter, update)).matched_count:
+                doc.mark_synced(state)
+                return
+            await self.rebase(doc)
+        raise WriteConflict(f"Document {doc['_id']} in {self.collection.name} kept changing while being written.")
+
+    async def rebase(self, doc):
+        fresh = await self.collection.find_one({"_id": doc["_id"]})
+        if fresh is None:   # Deleted from the database, so the whole document is inserted again as it is now
+            state = doc.snapshot()
+            try:
+                await self.collection.insert_one(state)
+                doc.mark_synced(state)
+                return
+            except DuplicateKeyError:   # Recreated by someone else in the meantime, so merge with theirs
+                fresh = await self.collection.find_one({"_id": doc["_id"]}) or {"_id": doc["_id"]}
+        doc.rebase(fresh)
+
+    async def flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        '''Write every buffered document with a single bulk_write. Documents that changed in the database
+        since they were synced are merged with the newer version and written again.'''
+        for _ in range(self.max_retries):
+            if not self.dirty:
+                return
+            for doc in await self.write_buffered():
+                await self.rebase(doc)
+                self.dirty.setdefault(doc["_id"], doc)
+        if self.dirty:
+            raise WriteConflict(f"Documents in {self.collection.name} kept changing while being written.")
 
-    @contextmanager
-    def doc_context(self, snowflake):
-        '''Incorporate get_doc and update_doc as a single contextmanager.'''
-        doc = self.get_doc(snowflake)
+    async def write_buffered(self):
+        docs, self.dirty = list(self.dirty.values()), {}
+        pending = [(doc, *doc.prepare_write()) for doc in docs]
+        pending = [(doc, filter, update, state) for doc, filter, update, state in pending if update]
+        conflicts = set()
+        try:
+            if pending:
+                requests = [UpdateRequest(filter, update) for _, filter, update, _ in pending]
+                if (await self.collection.bulk_write(requests, ordered=False)).matched_count < len(requests):
+                    # The result doesn't say which writes missed, but those documents won't have the new version
+                    ids = [doc["_id"] for doc, *_ in pending]
+                    versions = {doc["_id"]: doc.get("_version") async for doc in
+                                self.collection.find({"_id": {"$in": ids}}, {"_version": True})}
+                    conflicts = {doc["_id"] for doc, *_, state in pending
+                                 if versions.get(doc["_id"]) != state["_version"]}
+        except Exception:
+            for doc in docs:    # Keep the documents buffered so the next flush retries them
+                self.dirty.setdefault(doc["_id"], doc)
+            if self.write_behind and not self.flush_task:
+                self.flush_task = asyncio.create_task(self.flush_later())
+            raise
+        for doc, *_, state in pending:
+            if doc["_id"] not in conflicts:
+                doc.mark_synced(state)
+        return [doc for doc, *_ in pending if doc["_id"] in conflicts]
+
+    @asynccontextmanager
+    async def doc_context(self, snowflake):
+        '''Incorporate get_doc and update_doc as a single async contextmanager.'''
+        doc = await self.get_doc(snowflake)
         yield doc
-        self.update_doc(doc)
+        await self.update_doc(doc)
+
+
+class OnaQuoteDB:
+    '''Quotes are kept in their own collection, one document per quote, so they never bloat the user documents.
+    Each quote is indexed by the quoted user along with both its message id and its number, and both are unique.'''
+
+    shift = 1 << 30     # Larger than any quote number, see remove_quote
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.lock = asyncio.Lock()  # Adding and removing quotes renumbers them, so those writes take turns
+
+    async def create_indexes(self):
+        await self.collection.create_index([("user", ASCENDING), ("message", ASCENDING)], unique=True)
+        await self.collection.create_index([("user", ASCENDING), ("number", ASCENDING)], unique=True)
+
+    async def count(self, member):
+        return await self.collection.count_documents({"user": member.id})
+
+    async def get_quote(self, member, number):
+        '''Return the member's quote with this number, or None if there isn't one (i.e. it was just removed).'''
+        return await self.collection.find_one({"user": member.id, "number": number})
+
+    async def last_number(self, user_id):
+        last = await self.collection.find_one({"user": user_id}, {"number": True}, sort=[("number", DESCENDING)])
+        return last["number"] if last else 0
+
+    async def add_quote(self, member, quote):
+        '''Store a quote for the member and return its number, or None if the message was already quoted.'''
+        async with self.lock:
+            number = await self.last_number(member.id) + 1
+            try:
+                await self.collection.insert_one({**quote, "user": member.id, "number": number})
+            except DuplicateKeyError:
+                return None
+        return number
+
+    async def remove_quote(self, member, number):
+        '''Remove a quote and shift every later quote down by one. Returns False if there was no such quote.'''
+        async with self.lock:
+            if not (await self.collection.delete_one({"user": member.id, "number": number})).deleted_count:
+                return False
+            # Numbers are unique, and a single update_many could move quote 4 onto quote 3 before quote 3 has moved.
+            # So the later quotes are shifted out of the way into negative numbers first, then back down into place.
+            await self.collection.update_many({"user": member.id, "number": {"$gt": number}},
+                                              {"$inc": {"number": -self.shift}})
+            await self.collection.update_many({"user": member.id, "number": {"$lt": 0}},
+                                              {"$inc": {"number": self.shift - 1}})
+        return True
+
+    async def migrate(self, user_db):
+        '''Move quotes stored inline in user documents into this collection. Returns the number of quotes moved.
+        Migrated quotes are numbered after any the user already has in this collection, and running it again is
+        harmless, since quotes of messages that are already in the collection are skipped.'''
+        await user_db.flush()
+        moved = 0
+        async for user in user_db.collection.find({"quotes.0": {"$exists": True}}, {"quotes": True}):
+            async with self.lock:
+                quoted = {quote["message"] async for quote in self.collection.find({"user": user["_id"]},
+                                                                                   {"message": True})}
+                new_quotes = [quote for quote in user["quotes"] if quote["id"] not in quoted]
+                last = await self.last_number(user["_id"])
+                quotes = [{"message": quote["id"], "timestamp": quote["timestamp"], "content": quote["content"],
+                           "attachment": quote["attachment"], "user": user["_id"], "number": number}
+                          for number, quote in enumerate(new_quotes, last + 1)]
+                if quotes:
+                    moved += len((await self.collection.insert_many(quotes)).inserted_ids)
+            await user_db.collection.update_one({"_id": user["_id"]}, {"$unset": {"quotes": ""}})
+        for _id in list(user_db.doc_cache):     # Cached user documents still hold their old quotes
+            doc = user_db.doc_cache[_id]
+            doc.pop("quotes", None)
+            doc._synced.pop("quotes", None)
+        return moved
+
+
+class OnaPrefixIndex(dict):
+    '''A compact map of guild ids to command prefixes, so dispatching a message never needs the guild document
+    just to read the prefix. Entries are filled in on first use and updated whenever the prefix setting changes.'''
+
+    def __init__(self, guild_db):
+        super().__init__()
+        self.guild_db = guild_db
+
+    def __setitem__(self, _id, prefix):
+        # editsetting stores whatever JSON it's given, so a prefix may be a number or a list of prefixes.
+        # They're kept as a string or a tuple of strings, which both startswith and the command framework take.
+        if isinstance(prefix, (list, tuple)):
+            prefix = tuple(str(item) for item in prefix)
+        elif prefix is not None:
+            prefix = str(prefix)
+        super().__setitem__(_id, prefix)
+
+    async def get_prefix(self, guild):
+        _id = guild.id if guild else 0
+        if _id not in self:
+            self[_id] = (await self.guild_db.get_doc(guild)).prefix
+        return self[_id]
+
+    def may_be_command(self, message):
+        '''A fast check that only returns False for messages that definitely aren't commands.'''
+        prefix = self.get(message.guild.id if message.guild else 0)
+        return prefix is None or message.content.startswith(prefix)    # An unknown prefix is looked up normally
 
 
 def setup(ona):
-    ona.guild_db = OnaDB(ona.secrets.host, ona.secrets.port, ona.config.db,
-                         ona.config.guild_db, ona.guild_doc.to_dict(), ona.config.db_cache_size)
-    ona.user_db = OnaDB(ona.secrets.host, ona.secrets.port, ona.config.db,
-                        ona.config.user_db, ona.user_doc.to_dict(), ona.config.db_cache_size)
+    # The storage backend outlives reloads, so in-memory data and database connections are kept
+    if ona.config.storage == "memory" and not isinstance(getattr(ona, "storage", None), MemoryStorage):
+        ona.storage = MemoryStorage()
+    elif ona.config.storage == "mongo" and not isinstance(getattr(ona, "storage", None), MongoStorage):
+        ona.storage = MongoStorage(ona.secrets.host, ona.secrets.port, ona.config.db)
+
+    def options(collection):    # Cache sizing is per collection, write-behind settings are shared
+        return {"cache_size": ona.config.db_cache_sizes[collection], "cache_ttl": ona.config.db_cache_ttls[collection],
+                "write_behind": ona.config.write_behind, "flush_interval": ona.config.write_behind_interval,
+                "flush_size": ona.config.write_behind_size}
+    ona.guild_db = OnaDB(ona.storage.collection(ona.config.guild_db), ona.guild_doc.to_dict(),
+                         **options(ona.config.guild_db))
+    ona.user_db = OnaDB(ona.storage.collection(ona.config.user_db), ona.user_doc.to_dict(),
+                        **options(ona.config.user_db))
+    ona.r9k_db = OnaDB(ona.storage.collection(ona.config.r9k_db), ona.r9k_doc.to_dict(),
+                       **options(ona.config.r9k_db))
+    ona.dbs = [ona.guild_db, ona.user_db, ona.r9k_db]
+    ona.prefixes = OnaPrefixIndex(ona.guild_db)
+    ona.quote_db = OnaQuoteDB(ona.storage.collection(ona.config.quote_db))
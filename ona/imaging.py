@@ -0,0 +1,266 @@
+import asyncio
+import threading
+import multiprocessing
+from io import BytesIO
+from time import perf_counter
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageFilter, ImageDraw, ImageSequence, ImageOps
+from . import layout
+from .welcome import OnaWelcome
+
+
+class ImageError(Exception):
+    '''Raised by a job when the image can't be processed. The message is shown to the user.'''
+    pass
+
+
+# Everything below up to OnaImageEngine runs inside the worker processes.
+# A job description is the name of a job function (see jobs below) and its picklable arguments.
+
+worker = {}     # Resources preloaded once per worker process
+
+
+def init_worker(resources, gif_budget):
+    worker["resources"] = resources
+    worker["gif_budget"] = gif_budget  # (Most frames, most total pixels) in any gif that's encoded
+    with Image.open(resources["heart"]) as heart:
+        worker["heart"] = heart.convert("RGBA")
+    worker["welcome"] = OnaWelcome(resources)
+
+
+def encode(image, format, **params):
+    output = BytesIO()
+    image.save(output, format=format, **params)
+    return output.getvalue()
+
+
+def render_welcome(top_text, bot_text, avatar):
+    return worker["welcome"].render(top_text, bot_text, avatar).getvalue()
+
+
+def render_ship(avatars, avatar_size):
+    image = Image.new("RGBA", ((len(avatars) * 2 - 1) * avatar_size, avatar_size))
+    for i, avatar in enumerate(avatars):
+        with Image.open(BytesIO(avatar)) as avatar:
+            image.alpha_composite(avatar.convert(mode="RGBA"), dest=(avatar_size * i * 2, 0))   # Attach avatar
+        if i != 0:
+            image.alpha_composite(worker["heart"], dest=(avatar_size * (i * 2 - 1), 0))         # Attach heart
+    return encode(image, "PNG")
+
+
+def render_gif(images):
+    images = [Image.open(BytesIO(image)) for image in images]   # Only the headers are read until frames are used
+    new_size = max(image.size for image in images)  # Returns the size with either the largest height or width
+    frames = (frame.resize(new_size, Image.LANCZOS) for image in images for frame in ImageSequence.Iterator(image))
+    frames = budget_frames(frames, sum(getattr(image, "n_frames", 1) for image in images))
+    return encode(next(frames), "GIF", save_all=True, append_images=frames, optimize=True, loop=0)
+
+
+def edit_image(data, gif, edit, **options):
+    '''Apply one of the edits below to an image, or to every frame of a gif. Each edit is a pair of functions:
+    get_data runs once per image, and get_edited runs per frame with the data it returned.'''
+    get_data, get_edited = edits[edit]
+    with Image.open(BytesIO(data)) as image:
+        data = get_data(image, **options)
+        if gif:
+            frames = (get_edited(frame, data) for frame in ImageSequence.Iterator(image))
+            frames = budget_frames(frames, getattr(image, "n_frames", 1))
+            first = next(frames)
+            first.info = {**image.info, "duration": first.info.get("duration", image.info.get("duration"))}
+            return encode(first, "GIF", save_all=True, append_images=frames, optimize=True, loop=0)
+        return encode(get_edited(image, data), "PNG")
+
+
+def budget_frames(frames, count):
+    '''Pass gif frames through one at a time, so only the frame being edited is held at full size. Pillow's gif
+    encoder keeps every frame it's given until it writes the file, so this also keeps the output within budget:
+    frames are skipped evenly when there are too many (the kept ones last longer to match), and every frame
+    is downsampled when the kept frames would have too many pixels between them.'''
+    max_frames, max_pixels = worker["gif_budget"]
+    step = -(-count // max_frames)  # Keep every step-th frame
+    kept = -(-count // step)
+    scale = None
+    for i, frame in enumerate(frames):
+        if i % step:
+            continue
+        if scale is None:   # Frames in a gif all have the same size, so the first decides the scale
+            scale = min(1, (max_pixels / (kept * frame.width * frame.height)) ** 0.5)
+        duration = frame.info.get("duration")
+        if scale < 1:
+            frame = frame.resize((max(1, int(frame.width * scale)), max(1, int(frame.height * scale))), Image.LANCZOS)
+        if duration:
+            frame.info["duration"] = duration * step
+        yield frame
+
+
+def count_gif_frames(data):
+    '''Count the frames in a gif by walking its blocks, without decoding any of them.'''
+    if len(data) < 13:
+        return 0
+    pos, frames = 13, 0
+    if data[10] & 0x80:     # Skip the global color table
+        pos += 3 * 2 ** ((data[10] & 7) + 1)
+    while pos < len(data) and data[pos] != 0x3B:    # 0x3B is the trailer
+        if data[pos] == 0x21:   # Extension: introducer and label, then sub-blocks
+            pos += 2
+        elif data[pos] == 0x2C and pos + 9 < len(data):     # Image: descriptor, color table, code size, sub-blocks
+            frames += 1
+            flags = data[pos + 9]
+            pos += 10 + (3 * 2 ** ((flags & 7) + 1) if flags & 0x80 else 0) + 1
+        else:
+            break
+        while pos < len(data) and data[pos]:    # Sub-blocks are length-prefixed, ending with an empty one
+            pos += data[pos] + 1
+        pos += 1
+    return frames
+
+
+def get_new_size(image, magnification):
+    new_size = (int(image.width * magnification), int(image.height * magnification))
+    max_size = 5000
+    if new_size[0] >= max_size or new_size[1] >= max_size:
+        raise ImageError("This image is too large.")
+    return new_size
+
+
+def get_caption_data(image, caption):
+    '''Lay out the top and bottom text. Long captions wrap onto more lines instead of shrinking.'''
+    top, bottom = caption.upper().split("|", 1) if "|" in caption else (caption.upper(), "")
+    lines = []
+    for text, at_top in ((top.strip(), True), (bottom.strip(), False)):
+        if not text:
+            continue
+        font, text_lines = layout.fit_text(text, worker["resources"]["impact"], image.width - 20, image.height / 4,
+                                           max_lines=3)
+        height = layout.line_height(font) + 4
+        thickness = height // 20 + 1
+        y = 5 if at_top else image.height - height * len(text_lines) - 6
+        for line in text_lines:
+            lines.append({"pos": ((image.width - font.getsize(line)[0]) // 2, y), "text": line, "font": font,
+                          "thickness": thickness})
+            y += height
+    return lines
+
+
+def draw_outlined_text(draw, *, pos, text, font, thickness):
+    outline = (0, 0, 0, 255)
+    fill = (255, 255, 255, 255)
+    for x in [-thickness, 0, thickness]:
+        for y in [-thickness, 0, thickness]:
+            draw.text((pos[0] + x, pos[1] + y), text, fill=outline, font=font)
+    draw.text(pos, text, fill=fill, font=font)
+
+
+def get_captioned(image, lines):
+    image = image.convert(mode="RGBA")
+    draw = ImageDraw.Draw(image)
+    for line in lines:
+        draw_outlined_text(draw, **line)
+    return image
+
+
+edits = {
+    "resize": (get_new_size, lambda image, new_size: image.resize(new_size, Image.LANCZOS)),
+    "rotate": (lambda image, degrees: degrees, lambda image, degrees: image.rotate(degrees, resample=Image.BICUBIC)),
+    "filter": (lambda image, filter: getattr(ImageFilter, filter.upper()),
+               lambda image, filter: image.convert("RGBA").filter(filter)),
+    "invert": (lambda image: None, lambda image, data: ImageOps.invert(image.convert("RGB"))),
+    "meme": (get_caption_data, get_captioned)
+}
+
+# Jobs are submitted by name rather than by function, so a reference held somewhere that isn't reloaded
+# with this module can't send the workers a stale function object
+jobs = {job.__name__: job for job in (render_welcome, render_ship, render_gif, edit_image)}
+
+
+def job_call(job, args, kwargs):    # run_in_executor doesn't pass keyword arguments
+    return jobs[job](*args, **kwargs)
+
+
+class OnaImageEngine:
+    '''Runs image jobs in a pool of worker processes, so Pillow never blocks the event loop. Each worker preloads
+    its fonts and images when it starts. Guilds are limited to a few jobs at a time, so one busy guild can't
+    take over the whole pool.'''
+
+    def __init__(self, resources, workers, guild_jobs, gif_budget):
+        self.resources = resources
+        self.workers = workers
+        self.gif_budget = gif_budget
+        self.pool = self.create_pool()
+        self.guild_jobs = guild_jobs
+        self.semaphores = defaultdict(lambda: asyncio.Semaphore(self.guild_jobs))
+        self.waiting = self.running = 0     # Queue depth: jobs waiting on their guild's limit, and jobs in the pool
+        self.completed = self.failed = self.restarts = 0
+        self.total_time = self.max_time = 0.0
+
+    def create_pool(self):
+        # Workers are spawned rather than forked, so they don't inherit the event loop or Motor's threads
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_worker, initargs=(self.resources, self.gif_budget))
+
+    async def run(self, guild, job, *args, **kwargs):
+        '''Run the named job with the given arguments in a worker and return its result. ImageErrors raised
+        by the job are re-raised here. If a worker crashed, the pool is replaced and an ImageError is raised.'''
+        if job not in jobs:
+            raise ValueError(f"{job} isn't an image job.")
+        semaphore = self.semaphores[guild.id if guild else None]
+        self.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        pool, start = self.pool, perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(pool, job_call, job, args, kwargs)
+        except BrokenProcessPool:
+            self.failed += 1
+            if pool is self.pool:   # Only the first job to notice replaces the pool
+                retire(pool)
+                self.pool = self.create_pool()
+                self.restarts += 1
+            raise ImageError("The image worker crashed. Try again!")
+        except BaseException:
+            self.failed += 1
+            raise
+        else:
+            self.record(perf_counter() - start)
+            return result
+        finally:
+            self.running -= 1
+            semaphore.release()
+
+    def record(self, seconds):  # Only successful jobs are timed
+        self.completed += 1
+        self.total_time += seconds
+        self.max_time = max(self.max_time, seconds)
+
+    def stats(self):
+        return {"waiting": self.waiting, "running": self.running, "completed": self.completed,
+                "failed": self.failed, "restarts": self.restarts,
+                "avg_ms": self.total_time / self.completed * 1000 if self.completed else 0.0,
+                "max_ms": self.max_time * 1000}
+
+    def shutdown(self):
+        '''Shut the pool down without waiting for it. Used when the extension is unloaded.'''
+        retire(self.pool)
+
+    async def close(self):
+        '''Shut the pool down, and wait for running jobs to finish and the workers to exit. Used when Ona closes.'''
+        await asyncio.get_running_loop().run_in_executor(None, self.pool.shutdown)
+
+
+def retire(pool):
+    # shutdown(wait=False) leaves Python 3.8 hanging at exit, so a thread waits on the pool instead
+    threading.Thread(target=pool.shutdown, name="Image pool shutdown").start()
+
+
+def setup(ona):
+    gif_budget = (ona.config.gif_max_frames, ona.config.gif_max_pixels)
+    ona.images = OnaImageEngine(ona.resources, ona.config.image_workers, ona.config.image_guild_jobs, gif_budget)
+
+
+def teardown(ona):
+    ona.images.shutdown()   # Reloading starts a fresh pool, so the workers load the reloaded resources
@@ -0,0 +1,46 @@
+from functools import lru_cache
+from PIL import ImageFont
+
+
+@lru_cache(maxsize=128)
+def get_font(path, size):
+    '''Font files are only parsed once for each size they're used at.'''
+    return ImageFont.truetype(path, size)
+
+
+def line_height(font):
+    ascent, descent = font.getmetrics()
+    return ascent + descent
+
+
+def wrap(text, font, max_width):
+    '''Greedily wrap text into lines no wider than max_width. A word that's too wide on its own gets its own line.'''
+    lines = []
+    for word in text.split():
+        if lines and font.getsize(f"{lines[-1]} {word}")[0] <= max_width:
+            lines[-1] = f"{lines[-1]} {word}"
+        else:
+            lines.append(word)
+    return lines
+
+
+def fit_text(text, path, max_width, max_height, *, max_size=None, min_size=2, max_lines=1, spacing=4):
+    '''Binary search for the largest font size at which the text, wrapped over at most max_lines lines, fits in
+    a max_width by max_height box. Returns the font and the lines. If nothing fits, the smallest size is used.'''
+    def layout(size):
+        font = get_font(path, size)
+        lines = wrap(text, font, max_width) if max_lines > 1 else [text]
+        width = max(font.getsize(line)[0] for line in lines)
+        height = len(lines) * line_height(font) + (len(lines) - 1) * spacing
+        return font, lines, len(lines) <= max_lines and width <= max_width and height <= max_height
+
+    low, high = min_size, max_size or int(max_height)
+    best = layout(low)[:2]
+    while low <= high:
+        size = (low + high) // 2
+        font, lines, fits = layout(size)
+        if fits:
+            best, low = (font, lines), size + 1
+        else:
+            high = size - 1
+    return best
@@ -3,6 +3,9 @@ import discord
 from datetime import datetime
 from discord.ext import commands
 from .db import OnaDB
+from .assets import OnaAssetCache
+from .web import OnaWeb, OnaResponseCache
+from .staff_log import OnaStaffLog
 from .config_parser import OnaConfigParser
 from .utils import OnaUtilsMixin, not_blacklisted, not_silenced
 
@@ -24,9 +27,21 @@ class Ona(commands.Bot, OnaUtilsMixin):
         self.resources = {}
         for filename in os.listdir(os.path.join(dir, "resources")):
             self.resources[os.path.splitext(filename)[0]] = os.path.join(dir, "resources", filename)
+        # The asset cache is kept across reloads, downloaded avatars and emotes never change
+        asset_dir = self.config.asset_disk_dir and os.path.join(dir, self.config.asset_disk_dir)
+        self.assets = OnaAssetCache(self.config.asset_memory_bytes, asset_dir, self.config.asset_disk_bytes)
+        self.web = OnaWeb(timeout=self.config.web_timeout, connect_timeout=self.config.web_connect_timeout,
+                          connections=self.config.web_connections, host_connections=self.config.web_host_connections,
+                          dns_ttl=self.config.web_dns_ttl, retries=self.config.web_retries,
+                          backoff=self.config.web_backoff, breaker_failures=self.config.web_breaker_failures,
+                          probe_interval=self.config.web_probe_interval, max_hosts=self.config.web_max_hosts)
+        # Cached API responses are kept across reloads too, so repeat queries don't spend API quota
+        self.responses = OnaResponseCache(self.config.response_cache_size, self.config.response_ttls)
+        self.webhook_cache = {}     # Channel ids to webhook lookups, see get_webhook
+        self.staff_logs = OnaStaffLog(self, self.config.staff_log_window, self.config.staff_log_queue)
 
-        def get_prefix(ona, message):
-            return ona.guild_db.get_doc(message.guild).prefix   # The prefix is chosen based on the server's settings
+        async def get_prefix(ona, message):     # The prefix is chosen based on the server's settings
+            return await ona.prefixes.get_prefix(message.guild)
 
         activity = discord.Activity(type=discord.ActivityType.listening, name=self.config.activity)
         super().__init__(command_prefix=get_prefix, activity=activity)
@@ -43,6 +58,8 @@ class Ona(commands.Bot, OnaUtilsMixin):
 
     async def process_commands(self, message):
         ctx = await self.get_context(message, cls=self.OnaContext)
+        if ctx.valid:
+            await ctx.load_docs()
         await self.invoke(ctx)
         return ctx if ctx.valid else None   # For use in on_message if needed
 
@@ -50,6 +67,8 @@ class Ona(commands.Bot, OnaUtilsMixin):
     @commands.is_owner()
     async def reload(ctx):
         '''Update code, reload config settings, and refresh all cooldowns.'''
+        for db in ctx.ona.dbs:     # The databases are recreated on reload, so nothing buffered can be left behind
+            await db.flush()
         for filename in os.listdir(os.path.join(dir, "config")):
             setattr(ctx.ona, os.path.splitext(filename)[0], OnaConfigParser(os.path.join(dir, "config", filename)))
         ctx.ona.resources = {}
@@ -64,6 +83,18 @@ class Ona(commands.Bot, OnaUtilsMixin):
             print("Reload completed successfully.")
             await ctx.send("All commands were reloaded successfully.")
 
+    async def start(self, *args, **kwargs):
+        await self.web.open()   # The session has to be made inside the event loop
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await self.staff_logs.close()   # Deliver queued staff logs while the connection to Discord is still open
+        for db in self.dbs:     # Write out any buffered documents before shutting down
+            await db.flush()
+        await self.web.close()
+        await self.images.close()
+        await super().close()
+
     async def on_message(self, message):
         pass    # Override the call to process_commands, we'll call it in the Events cog instead
 
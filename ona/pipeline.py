@@ -0,0 +1,87 @@
+from time import perf_counter
+from functools import cached_property
+
+
+class MessageState:
+    '''Everything the pipeline stages share about one message. The guild document is resolved once up front,
+    and the permission snapshots are only computed if a stage asks for them.'''
+
+    def __init__(self, message, guild_doc):
+        self.message = message
+        self.guild_doc = guild_doc
+        self.done = False   # Set by a stage to skip every stage after it
+
+    @cached_property
+    def permissions(self):
+        return self.message.channel.permissions_for(self.message.author)
+
+    @cached_property
+    def my_permissions(self):
+        return self.message.channel.permissions_for(self.message.guild.me if self.message.guild else
+                                                    self.message.channel.me)
+
+    async def delete(self):
+        '''Delete the message. No later stage will see it.'''
+        await self.message.delete()
+        self.done = True
+
+
+class StageTimer:
+    def __init__(self):
+        self.calls = 0
+        self.total = self.max = 0.0
+
+    def record(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class OnaPipeline:
+    '''Every incoming message passes once through an ordered list of stages, instead of through a separate
+    listener per feature. Stages are coroutines that take a MessageState, registered by name with an order.'''
+
+    def __init__(self, ona):
+        self.ona = ona
+        self.stages = []    # (order, name, stage) tuples, kept sorted
+        self.timers = {}
+
+    def add_stage(self, name, stage, order):
+        self.remove_stage(name)     # Re-adding a stage (i.e. on reload) replaces it
+        self.stages = sorted([*self.stages, (order, name, stage)], key=lambda entry: entry[0])
+        self.timers.setdefault(name, StageTimer())
+
+    def remove_stage(self, name):
+        self.stages = [entry for entry in self.stages if entry[1] != name]
+
+    async def process(self, message):
+        '''Run the message through every stage in order. A stage that raises is reported, and the message still
+        goes on to the stages after it.'''
+        state = MessageState(message, await self.ona.guild_db.get_doc(message.guild))
+        for _, name, stage in self.stages:
+            start = perf_counter()
+            try:
+                await stage(state)
+            except Exception as e:
+                await self.report(name, e)
+            finally:
+                self.timers[name].record(perf_counter() - start)
+            if state.done:
+                break
+        return state
+
+    async def report(self, name, error):
+        '''Print an exception from a stage and post it to the main guild's logs, the same way on_error does.'''
+        error_text = (f"{type(error).__name__} in the {name} stage: {error} "
+                      f"(line #{error.__traceback__.tb_next.tb_lineno})")
+        print(error_text)
+        try:
+            embed = self.ona.embed(error_text, timestamp=True, author=self.ona.user)
+            main_guild = self.ona.get_guild(self.ona.config.main_guild)
+            await main_guild.get_channel((await self.ona.guild_db.get_doc(main_guild)).logs).send(embed=embed)
+        except Exception as e:  # Reporting mustn't stop the message from reaching later stages
+            print(f"{type(e).__name__} while reporting a stage error: {e}")
+
+
+def setup(ona):
+    ona.pipeline = OnaPipeline(ona)
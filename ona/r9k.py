@@ -0,0 +1,46 @@
+from hashlib import blake2b
+
+
+class OnaR9K:
+    '''An index of hashed message contents for each R9K channel, so duplicates are found with a local set lookup
+    instead of by paging through the channel's history. Each channel keeps its most recent size hashes,
+    persisted in the r9k collection.'''
+
+    def __init__(self, r9k_db, size):
+        self.r9k_db = r9k_db
+        self.size = size
+        self.hash_sets = {}     # Channel ids to sets mirroring each document's hash list
+
+    @staticmethod
+    def digest(content):    # Case and whitespace differences don't make a message original
+        return blake2b(" ".join(content.lower().split()).encode(), digest_size=8).hexdigest()
+
+    async def get_hash_set(self, channel):
+        if channel.id not in self.hash_sets:
+            hashes = (await self.r9k_db.get_doc(channel)).hashes
+            # Another message may have built (and added to) the set during the await, so its set is kept
+            return self.hash_sets.setdefault(channel.id, set(hashes))
+        return self.hash_sets[channel.id]
+
+    async def add(self, channel, contents):
+        hash_set = await self.get_hash_set(channel)
+        digests = [digest for digest in dict.fromkeys(map(self.digest, contents)) if digest not in hash_set]
+        hash_set.update(digests)    # Before the next await, so a duplicate sent right after is already caught
+        async with self.r9k_db.doc_context(channel) as r9k_doc:
+            r9k_doc.hashes.extend(digests)
+            if len(r9k_doc.hashes) > self.size * 1.1:     # Trimming in chunks keeps most writes as plain $push
+                hash_set.difference_update(r9k_doc.hashes[:-self.size])
+                del r9k_doc.hashes[:-self.size]
+
+    async def is_duplicate(self, channel, content):
+        '''Return True if the content was already posted in the channel. Otherwise, remember it.'''
+        if self.digest(content) in await self.get_hash_set(channel):
+            return True
+        await self.add(channel, [content])
+        return False
+
+    async def seed(self, channel, min_length):
+        '''Fill the index from the channel's recent history, oldest messages first.'''
+        contents = [message.content async for message in channel.history(limit=self.size, oldest_first=False)
+                    if len(message.content) >= min_length]
+        await self.add(channel, reversed(contents))
@@ -0,0 +1,113 @@
+import asyncio
+from time import monotonic
+
+
+class OnaStaffLog:
+    '''Staff log embeds are queued per guild and sent in batches of up to 10 embeds per webhook message, instead of
+    one message per action. A batch is collected for up to window seconds, and only holds consecutive entries from
+    the same moderator to the same channel, so the logs stay in order. Each guild's queue is bounded: once it's full,
+    logging waits for room rather than letting a burst of actions pile up in memory.'''
+
+    batch_size = 10     # The most embeds Discord allows in one message
+    batch_chars = 6000  # The most characters Discord allows across all of a message's embeds
+
+    def __init__(self, ona, window, queue_size):
+        self.ona = ona
+        self.window = window
+        self.queue_size = queue_size
+        self.queues = {}    # Guild ids to queues of (channel, username, avatar_url, embed) entries
+        self.workers = {}
+        self.held = {}  # Entries taken from a queue that didn't fit the last batch
+        self.flushing = False   # While set, batches are sent as soon as the queue is empty instead of after window
+        self.closing = False    # While set, the workers also stop once their queue is empty
+
+    async def log(self, channel, embed, *, username=None, avatar_url=None):
+        guild_id = channel.guild.id
+        if guild_id not in self.queues:
+            self.queues[guild_id] = asyncio.Queue(maxsize=self.queue_size)
+        if guild_id not in self.workers or self.workers[guild_id].done():
+            self.workers[guild_id] = asyncio.ensure_future(self.deliver(guild_id))
+        await self.queues[guild_id].put((channel, username, avatar_url, embed))
+
+    def wake(self):
+        '''Put a None into each queue, so workers waiting on an empty queue (or on the window) check the flags.'''
+        for queue in self.queues.values():
+            try:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:   # A full queue doesn't keep its worker waiting anyway
+                pass
+
+    async def deliver(self, guild_id):
+        queue = self.queues[guild_id]
+        while True:
+            entry = self.held.pop(guild_id, None) or await queue.get()
+            if entry is None:
+                queue.task_done()
+                if self.closing and queue.empty():
+                    return
+                continue
+            batch, chars = [entry], len(entry[3])
+            deadline = monotonic() + self.window
+            while len(batch) < self.batch_size:
+                try:
+                    if self.flushing or self.closing or deadline <= monotonic():
+                        entry = queue.get_nowait()
+                    else:
+                        entry = await asyncio.wait_for(queue.get(), deadline - monotonic())
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if entry is None:   # Woken up, so send what's been collected
+                    queue.task_done()
+                    break
+                # A different moderator or channel, or an embed that doesn't fit, starts the next batch
+                if entry[:3] != batch[0][:3] or chars + len(entry[3]) > self.batch_chars:
+                    self.held[guild_id] = entry
+                    break
+                batch.append(entry)
+                chars += len(entry[3])
+            try:
+                await self.send(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+            if self.closing and queue.empty() and guild_id not in self.held:
+                return
+
+    async def send(self, batch):
+        '''Send a batch as one message. If Discord rejects it, each embed is sent on its own,
+        so one bad embed doesn't lose the rest of the batch.'''
+        channel, username, avatar_url, _ = batch[0]
+        embeds = [embed for *_, embed in batch]
+        for attempt in ([embeds] if len(embeds) == 1 else [embeds, *([embed] for embed in embeds)]):
+            try:
+                await self.ona.send_webhook(channel, username=username, avatar_url=avatar_url, embeds=attempt)
+            except Exception as e:
+                print(f"{type(e).__name__} while sending staff logs: {e}")
+            else:
+                if attempt is embeds:   # The whole batch was sent at once
+                    return
+
+    async def flush(self):
+        '''Send everything that's queued without waiting out the batching window.'''
+        self.flushing = True
+        try:
+            self.wake()
+            await asyncio.gather(*(queue.join() for queue in self.queues.values()))
+        finally:
+            self.flushing = False
+
+    async def close(self):
+        '''Send everything that's queued, then stop the workers. Used when Ona shuts down.
+        Logging afterwards starts new workers.'''
+        self.closing = True
+        try:
+            self.wake()
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        finally:
+            self.closing = False
+        for guild_id, queue in list(self.queues.items()):
+            if queue.empty() and guild_id not in self.held:
+                del self.queues[guild_id]
+                self.workers.pop(guild_id, None)
+            else:   # Logged after its worker had already stopped
+                self.workers[guild_id] = asyncio.ensure_future(self.deliver(guild_id))
@@ -0,0 +1,277 @@
+from copy import deepcopy
+from types import SimpleNamespace
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from motor.motor_asyncio import AsyncIOMotorClient
+
+
+class UpdateRequest(UpdateOne):
+    '''An UpdateOne for bulk_write that keeps its arguments readable, since UpdateOne only stores them privately.
+    MemoryCollection.bulk_write reads them, and MongoDB gets a plain UpdateOne.'''
+
+    def __init__(self, filter, update, upsert=False):
+        super().__init__(filter, update, upsert=upsert)
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+
+
+class MongoStorage:
+    '''Storage backed by a MongoDB server. Collections are Motor collections.'''
+
+    def __init__(self, host, port, db):
+        self.client = AsyncIOMotorClient(host, port)
+        self.db = self.client[db]
+
+    def collection(self, name):
+        return self.db[name]
+
+
+class MemoryStorage:
+    '''Storage kept entirely in process memory, for single-guild deployments, development and benchmarks.
+    Its collections implement the subset of the Motor collection API that Ona uses. Nothing is persisted.'''
+
+    def __init__(self):
+        self.collections = {}
+
+    def collection(self, name):
+        return self.collections.setdefault(name, MemoryCollection(name))
+
+
+class MemoryCollection:
+    '''An in-memory stand-in for a Motor collection. Documents are copied on the way in and out,
+    so callers can never modify stored documents without an update, just like with MongoDB.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.unique_indexes = {}    # Field tuples that must be unique across documents, to {key: _id} dicts
+        self.next_id = 1
+
+    async def create_index(self, keys, unique=False, **_):
+        fields = tuple(field for field, _ in keys)
+        if unique and fields not in self.unique_indexes:
+            index = {}
+            for doc in self.docs.values():
+                if index.setdefault(index_key(doc, fields), doc["_id"]) != doc["_id"]:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {fields}")
+            self.unique_indexes[fields] = index
+        return "_".join(fields)
+
+    async def find_one(self, filter=None, projection=None, *, sort=None):
+        return next(self.search(filter, projection, sort), None)
+
+    def find(self, filter=None, projection=None, *, sort=None):
+        return MemoryCursor(self.search(filter, projection, sort))
+
+    async def count_documents(self, filter):
+        return sum(1 for doc in self.candidates(filter) if matches(doc, filter))
+
+    async def insert_one(self, doc):
+        doc = deepcopy(doc)
+        if "_id" not in doc:
+            doc["_id"], self.next_id = self.next_id, self.next_id + 1
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+        self.check_unique(doc)
+        self.store(doc)
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    async def insert_many(self, docs, ordered=True):
+        inserted, errors = [], []
+        for i, doc in enumerate(docs):
+            try:
+                inserted.append((await self.insert_one(doc)).inserted_id)
+            except DuplicateKeyError as e:
+                errors.append({"index": i, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted)})
+        return SimpleNamespace(inserted_ids=inserted)
+
+    async def update_one(self, filter, update, upsert=False):
+        doc = next((doc for doc in self.candidates(filter) if matches(doc, filter)), None)
+        if doc:
+            self.apply(doc, update)
+            return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = {key: value for key, value in filter.items() if not isinstance(value, dict)}
+            apply_update(doc, update, inserting=True)
+            _id = (await self.insert_one(doc)).inserted_id
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=_id)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def update_many(self, filter, update):
+        docs = [doc for doc in self.candidates(filter) if matches(doc, filter)]
+        for doc in docs:
+            self.apply(doc, update)
+        return SimpleNamespace(matched_count=len(docs), modified_count=len(docs))
+
+    async def find_one_and_update(self, filter, update, *, upsert=False, return_document=ReturnDocument.BEFORE):
+        before = await self.find_one(filter)
+        result = await self.update_one(filter, update, upsert=upsert)
+        if return_document == ReturnDocument.BEFORE or not before and result.upserted_id is None:
+            return before
+        return await self.find_one({"_id": before["_id"] if before else result.upserted_id})
+
+    async def delete_one(self, filter):
+        doc = next((doc for doc in self.candidates(filter) if matches(doc, filter)), None)
+        if doc:
+            self.discard(doc)
+        return SimpleNamespace(deleted_count=int(bool(doc)))
+
+    async def bulk_write(self, requests, ordered=True):
+        matched, upserted, errors = 0, {}, []
+        for i, request in enumerate(requests):  # Only UpdateRequests are used by OnaDB
+            try:
+                result = await self.update_one(request.filter, request.update, upsert=request.upsert)
+            except DuplicateKeyError as e:
+                errors.append({"index": i, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+                continue
+            matched += result.matched_count
+            if result.upserted_id is not None:
+                upserted[i] = result.upserted_id
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nMatched": matched, "nUpserted": len(upserted)})
+        return SimpleNamespace(matched_count=matched, modified_count=matched, upserted_ids=upserted)
+
+    def candidates(self, filter):
+        '''Narrow a query down by _id when the filter allows it, instead of scanning every document.'''
+        _id = filter.get("_id")
+        if _id is None:
+            return list(self.docs.values())
+        ids = _id["$in"] if isinstance(_id, dict) and "$in" in _id else [_id] if not isinstance(_id, dict) else None
+        return [self.docs[i] for i in ids if i in self.docs] if ids is not None else list(self.docs.values())
+
+    def search(self, filter, projection, sort):
+        docs = [doc for doc in self.candidates(filter or {}) if matches(doc, filter or {})]
+        for field, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: get_path(doc, field)[1], reverse=direction < 0)
+        for doc in docs:
+            if projection:
+                fields = [field for field, included in projection.items() if included]
+                doc = {key: value for key, value in doc.items() if key in fields or key == "_id"}
+            yield deepcopy(doc)
+
+    def check_unique(self, new_doc):
+        for fields, index in self.unique_indexes.items():
+            if index.get(index_key(new_doc, fields), new_doc["_id"]) != new_doc["_id"]:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {fields}")
+
+    def store(self, doc):
+        self.docs[doc["_id"]] = doc
+        for fields, index in self.unique_indexes.items():
+            index[index_key(doc, fields)] = doc["_id"]
+
+    def discard(self, doc):
+        del self.docs[doc["_id"]]
+        for fields, index in self.unique_indexes.items():
+            index.pop(index_key(doc, fields), None)
+
+    def apply(self, doc, update):
+        '''Update a stored document. With unique indexes, the update is made to a copy that only replaces the
+        document if it doesn't collide with another one, like a rejected update in MongoDB.'''
+        if not self.unique_indexes:
+            apply_update(doc, update)
+            return
+        new_doc = deepcopy(doc)
+        apply_update(new_doc, update)
+        self.check_unique(new_doc)
+        self.discard(doc)
+        self.store(new_doc)
+
+
+class MemoryCursor:
+    '''Supports async iteration, like a Motor cursor.'''
+
+    def __init__(self, docs):
+        self.docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def apply_update(doc, update, inserting=False):
+    '''Apply the update operators that OnaDB and OnaQuoteDB send (as well as $setOnInsert when inserting)
+    to a document in place.'''
+    for path, value in update.get("$setOnInsert", {}).items() if inserting else ():
+        set_path(doc, path, deepcopy(value))
+    for path, value in update.get("$set", {}).items():
+        set_path(doc, path, deepcopy(value))
+    for path in update.get("$unset", {}):
+        parent, key = get_parent(doc, path)
+        parent.pop(key, None)
+    for path, amount in update.get("$inc", {}).items():
+        exists, current = get_path(doc, path)
+        set_path(doc, path, current + amount if exists else amount)
+    for path, value in update.get("$push", {}).items():
+        items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+        exists, current = get_path(doc, path)
+        set_path(doc, path, (current if exists else []) + deepcopy(items))
+    for path, value in update.get("$pull", {}).items():
+        removed = value["$in"] if isinstance(value, dict) and "$in" in value else [value]
+        exists, current = get_path(doc, path)
+        if exists:
+            set_path(doc, path, [item for item in current if item not in removed])
+
+
+def index_key(doc, fields):
+    return tuple(get_path(doc, field)[1] for field in fields)
+
+
+def get_path(doc, path):
+    '''Follow a dotted path through dicts and lists. Returns whether the path exists and the value found there.'''
+    value = doc
+    for key in path.split("."):
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return False, None
+    return True, value
+
+
+def get_parent(doc, path):
+    *parents, key = path.split(".")
+    for parent in parents:
+        doc = doc.setdefault(parent, {})
+    return doc, key
+
+
+def set_path(doc, path, value):
+    parent, key = get_parent(doc, path)
+    parent[key] = value
+
+
+def matches(doc, filter):
+    '''Check a document against a filter of field equalities and the $in, $gt, $lt and $exists operators.'''
+    for path, condition in filter.items():
+        exists, value = get_path(doc, path)
+        if condition is None:   # Like MongoDB, null also matches missing fields
+            if exists and value is not None:
+                return False
+            continue
+        if not isinstance(condition, dict):
+            if not exists or value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if operator == "$exists" and exists != operand:
+                return False
+            if operator == "$in" and (not exists or value not in operand):
+                return False
+            if operator == "$gt" and (not exists or not value > operand):
+                return False
+            if operator == "$lt" and (not exists or not value < operand):
+                return False
+    return True
@@ -1,13 +1,13 @@
-import os
-import random
-import itertools
+import asyncio
 import discord
-from aiohttp import ClientSession
+from aiohttp import ClientConnectionError
 from contextlib import contextmanager
-from datetime import timedelta, datetime
+from datetime import datetime
 from discord.ext import commands
-from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
+from PIL import Image
+from . import imaging
+from .web import HostUnavailable
 
 
 class OnaUtilsMixin:
@@ -41,71 +41,126 @@ class OnaUtilsMixin:
 
     async def create_welcome(self, member):
         '''Creates a welcome banner for the given member.'''
-        welcome = Image.open(os.path.join(self.resources["welcomes"],
-                             random.choice(os.listdir(self.resources["welcomes"]))))
-        avi = Image.open(BytesIO(await member.avatar_url_as(static_format="png", size=64).read()))
-        draw = ImageDraw.Draw(welcome)
+        avatar = await self.assets.read(member.avatar_url_as(static_format="png", size=64))
         member_name = self.asciify(member.name)
         member_name = f"{member_name[:12]}..." if len(member_name) > 32 else member_name
         top_text = f"Welcome,\n{member_name}"
         bot_text = f"You're our {self.ordinal(member.guild.member_count)} member!"
-        top_font_size, bot_font_size = 80, 55
-        top_font = ImageFont.truetype(self.resources["tenshi_font"], top_font_size)
-        bot_font = ImageFont.truetype(self.resources["tenshi_font"], bot_font_size)
-        text_size = draw.multiline_textsize(top_text, font=top_font)[0] // 2
-        top_text_x, top_text_y = 670, 170
-        bot_text_x, bot_text_y = 375, 350
-        top_outline, bot_outline = 2, 2
-        white = (255, 255, 255, 255)
-        blue = (15, 90, 170, 255)
-        for x_offset, y_offset in itertools.product((-2, 2), (-2, 2)):      # Draw the outline around the text
-            draw.multiline_text((top_text_x - text_size + x_offset, top_text_y + y_offset), top_text,
-                                align="center", font=top_font, fill=white)
-            draw.multiline_text((bot_text_x + x_offset, bot_text_y + y_offset), bot_text,
-                                align="center", font=bot_font, fill=white)
-        draw.multiline_text((top_text_x - text_size, top_text_y), top_text, # Draw the top text and bottom text
-                            align="center", font=top_font, fill=blue)
-        draw.multiline_text((bot_text_x, bot_text_y), bot_text,
-                            align="center", font=bot_font, fill=blue)
-        size = 165
-        avi = avi.resize((size, size))
-        circle = Image.new("L", (size, size), 0)
-        ImageDraw.Draw(circle).ellipse((0, 0, size, size), fill=255)
-        avi.putalpha(circle)
-        welcome.alpha_composite(avi, (20, 150))
-        welcome_image = BytesIO()
-        welcome.save(welcome_image, format="PNG")
-        welcome_image.seek(0)
-        return welcome_image
-
-    async def request(self, url, *, method="GET", **kwargs):
+        return BytesIO(await self.images.run(member.guild, "render_welcome", top_text, bot_text, avatar))
+
+    async def request(self, url, *, method="GET", cache=None, **kwargs):
         '''This helper coroutine makes a request to a url.
-        If the request returns JSON, this coroutine returns a dict. Otherwise, it returns a bytes object.'''
-        async with ClientSession(headers={"User-Agent": "Ona Agent"}) as session:
-            async with session.request(method, url, **kwargs) as result:
-                self.assert_(200 <= result.status < 300,
-                             error="An error occurred while connecting to the server. Try again!")
-                return await result.json() if result.content_type == "application/json" else await result.read()
+        If the request returns JSON, this coroutine returns a dict. Otherwise, it returns a bytes object.
+        GET requests can be cached by giving an endpoint name from the response_ttls config as cache.
+        Cached responses are shared, so don't modify them.'''
+        if cache and method == "GET":
+            key = self.responses.key(cache, url, kwargs.get("params"))
+            return await self.responses.get(key, lambda: self.request(url, **kwargs))
+
+        async def read(result):
+            self.assert_(200 <= result.status < 300,
+                         error="An error occurred while connecting to the server. Try again!")
+            return await result.json() if result.content_type == "application/json" else await result.read()
+        return await self.fetch(method, url, read, **kwargs)
+
+    async def fetch(self, method, url, handle, **kwargs):
+        '''Make a request through the shared web client, turning network failures into OnaErrors.'''
+        try:
+            return await self.web.fetch(method, url, handle, **kwargs)
+        except HostUnavailable as e:
+            raise self.OnaError(f"`{e}` isn't responding right now. Try again later!")
+        except asyncio.TimeoutError:
+            raise self.OnaError("The server took too long to respond. Try again!")
+        except ClientConnectionError:
+            raise self.OnaError("An error occurred while connecting to the server. Try again!")
+
+    async def request_image(self, url, *, max_bytes=None):
+        '''Download an image given by a user. The download is streamed, so a file that's too large (in bytes,
+        or in pixels once decoded) is refused before all of it is downloaded, and long before it's decoded.'''
+        max_bytes = max_bytes or self.config.download_max_bytes
+        too_large = f"That image is too large. The limit is {max_bytes // 1024:,} KB."
+        too_many_pixels = "That image has too many pixels to edit."
+        header_bytes = 1024 * 1024  # Headers (including metadata before them, like EXIF) are found near the start
+
+        def read_header(data):
+            '''Image.open only reads the header, so the size can be checked before anything is decoded.
+            Returns None if there isn't enough of the file yet to identify it.'''
+            try:
+                image = Image.open(BytesIO(data))
+            except Image.DecompressionBombError:
+                raise self.OnaError(too_many_pixels)
+            except Exception:
+                return None
+            # APNG has its frame count in the header. Counting gif frames means seeking through them all,
+            # so gifs are counted from the raw data once they're downloaded.
+            frames = getattr(image, "n_frames", 1) if image.format != "GIF" else 1
+            self.assert_(image.width * image.height * frames <= self.config.image_max_pixels, error=too_many_pixels)
+            return image
+
+        async def download(result):
+            self.assert_(200 <= result.status < 300,
+                         error="An error occurred while connecting to the server. Try again!")
+            self.assert_(result.content_type in self.config.image_types, error="That isn't a supported image.")
+            self.assert_((result.content_length or 0) <= max_bytes, error=too_large)
+            data, image = bytearray(), None
+            async for chunk in result.content.iter_chunked(65536):
+                data += chunk
+                self.assert_(len(data) <= max_bytes, error=too_large)
+                if image is None and len(data) <= header_bytes:
+                    image = read_header(bytes(data))
+            return data, image or read_header(bytes(data))
+        data, image = await self.fetch("GET", url, download)
+        self.assert_(image, error="That isn't a valid image.")
+        if image.format == "GIF":   # Gifs don't give their frame count up front, so count them without decoding
+            self.assert_(image.width * image.height * imaging.count_gif_frames(data) <= self.config.image_max_pixels,
+                         error=too_many_pixels)
+        return bytes(data)
 
     async def google_search(self, query, image=False):
         '''Search Google with a query. Retrieve image results if image=True.'''
         params = {"q": query, "key": self.secrets.google_key, "cx": self.secrets.google_engine_id}
         if image:
             params["searchType"] = "image"
-        return (await self.request("https://www.googleapis.com/customsearch/v1", params=params))["items"]
+        url = "https://www.googleapis.com/customsearch/v1"
+        return (await self.request(url, params=params, cache="google"))["items"]
 
-    async def send_webhook(self, channel, content=None, *, username=None, avatar_url=None, file=None, embed=None):
+    async def send_webhook(self, channel, content=None, *, username=None, avatar_url=None, file=None, embed=None,
+                           embeds=None):
         '''Abstract the use of webhooks for a TextChannel. If Ona doesn't have the manage_webhooks permission,
-        the message will be sent normally instead.'''
+        the message will be sent normally instead. Up to 10 embeds can be sent in one webhook message.'''
         if isinstance(channel, discord.TextChannel) and channel.permissions_for(channel.guild.me).manage_webhooks:
-            webhooks = await channel.webhooks()
-            if not webhooks:
-                webhooks.append(await channel.create_webhook(name="Ona Webhook"))
-            await webhooks[0].send(self.sanitize(content), username=username or channel.guild.me.display_name,
-                                   avatar_url=avatar_url or self.user.avatar_url, file=file, embed=embed)
+            kwargs = {"username": username or channel.guild.me.display_name,
+                      "avatar_url": avatar_url or self.user.avatar_url, "file": file}
+            kwargs.update({"embeds": embeds} if embeds else {"embed": embed})
+            try:
+                await (await self.get_webhook(channel)).send(self.sanitize(content), **kwargs)
+            except discord.NotFound:    # The cached webhook was deleted, so find or make another one
+                self.webhook_cache.pop(channel.id, None)
+                if file:
+                    file.reset()
+                await (await self.get_webhook(channel)).send(self.sanitize(content), **kwargs)
+        elif embeds:    # Bots can only send one embed per message
+            for i, embed in enumerate(embeds):
+                await channel.send(self.sanitize(content) if i == 0 else None, file=file if i == 0 else None,
+                                   embed=embed)
         else:
             await channel.send(self.sanitize(content), file=file, embed=embed)
 
+    async def get_webhook(self, channel):
+        '''Return a webhook for the channel, creating one if there are none. Webhooks are cached per channel
+        until the channel's webhooks change. Concurrent calls for the same channel share one lookup.'''
+        if channel.id not in self.webhook_cache:
+            self.webhook_cache[channel.id] = asyncio.ensure_future(self.find_webhook(channel))
+        try:
+            return await asyncio.shield(self.webhook_cache[channel.id])
+        except Exception:
+            self.webhook_cache.pop(channel.id, None)    # Don't cache failures
+            raise
+
+    async def find_webhook(self, channel):
+        webhooks = [webhook for webhook in await channel.webhooks() if webhook.token]   # Only ones we can send with
+        return webhooks[0] if webhooks else await channel.create_webhook(name="Ona Webhook")
+
     @staticmethod
     def plural(value, word):
         value = int(value) if float(value).is_integer() else value  # Remove .0 if it exists
@@ -131,37 +186,32 @@ class OnaUtilsMixin:
 # Various command checks
 
 def not_blacklisted(ctx):
-    return ctx.ona.assert_(ctx.channel.id not in ctx.guild_doc.blacklist,
-                           error="Commands have been disabled in this channel.")
+    return ctx.ona.assert_(not ctx.check_snapshot.blacklisted, error="Commands have been disabled in this channel.")
 
 
 def not_silenced(ctx):
-    if ctx.channel.permissions_for(ctx.author).manage_messages:
+    if ctx.check_snapshot.manage_messages:
         return True
-    ctx.ona.assert_(not ctx.guild or ctx.guild.id not in ctx.author_doc.silenced,
-                    error="You've been silenced in this server.")
-    if ctx.channel.id not in ctx.guild_doc.chat_throttle:
+    ctx.ona.assert_(not ctx.check_snapshot.silenced, error="You've been silenced in this server.")
+    if not ctx.check_snapshot.chat_throttled:
         return True
-    return ctx.ona.assert_(not ctx.guild or not ctx.guild_doc.silent,
+    return ctx.ona.assert_(not ctx.check_snapshot.silent,
                            error="Silent mode is currently enabled. Try another channel instead.")
 
 
 # This check ignores all channels not on the image_throttle list
-async def image_throttle(ctx):
-    if ctx.message.id not in ctx.guild_doc.image_throttle:
+def image_throttle(ctx):
+    if not ctx.check_snapshot.image_throttled:
         return True
-    # OnaError if there are too many images in the channel
-    last_ten = await ctx.history(limit=10).flatten()
-    return ctx.ona.assert_(sum(len(message.attachments) for message in last_ten) > 2,
+    # OnaError if there have been too many images in the channel's recent messages
+    return ctx.ona.assert_(not ctx.ona.activity.image_throttled(ctx.channel, ctx.guild_doc),
                            error="There are too many images here. Try again later!")
 
 
 # This check ignores all channels not on the chat_throttle list
-async def chat_throttle(ctx):
-    if ctx.channel.id not in ctx.guild_doc.chat_throttle:
+def chat_throttle(ctx):
+    if not ctx.check_snapshot.chat_throttled:
         return True
-    # OnaError if the 10th oldest message is <40 seconds old
-    async for message in ctx.history(limit=10):
-        oldest = message
-    return ctx.ona.assert_(oldest.timestamp + timedelta(0, 40) > datetime.utcnow(),
+    # OnaError if the channel's recent messages all arrived too quickly
+    return ctx.ona.assert_(not ctx.ona.activity.chat_throttled(ctx.channel, ctx.guild_doc),
                            error="The chat is too active. Try again later!")
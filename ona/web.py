@@ -0,0 +1,188 @@
+import random
+import asyncio
+from time import monotonic
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientConnectionError, ClientError
+
+
+class HostUnavailable(Exception):
+    '''Raised instead of making a request while a host's circuit breaker is open.'''
+    pass
+
+
+class RetryableStatus(Exception):
+    pass
+
+
+class HostHealth:
+    '''Latency and failure tracking for one host. After enough consecutive failures the breaker opens,
+    and requests to the host fail immediately until a background probe gets a response from it.'''
+
+    def __init__(self):
+        self.requests = self.failures = self.consecutive_failures = 0
+        self.latency = None     # Moving average, in seconds
+        self.max_latency = 0.0
+        self.probe = None   # The probing task, while the breaker is open
+        self.last_failure = None    # The (method, url, request options) that last failed, which the probe retries
+
+    @property
+    def open(self):
+        return self.probe is not None and not self.probe.done()
+
+    def success(self, seconds):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.latency = seconds if self.latency is None else self.latency * 0.8 + seconds * 0.2
+        self.max_latency = max(self.max_latency, seconds)
+
+    def failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+
+
+class OnaWeb:
+    '''The bot's one HTTP client for everything other than Discord. The session is opened when Ona starts and
+    closed when Ona closes, so connections (and their TLS sessions) are kept alive and reused between requests,
+    and DNS lookups are cached. Health is tracked for the most recently used max_hosts hosts, since user images
+    can come from anywhere.'''
+
+    idempotent = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+    def __init__(self, *, timeout, connect_timeout, connections, host_connections, dns_ttl, retries=2, backoff=0.5,
+                 breaker_failures=5, probe_interval=30, max_hosts=256):
+        self.timeout = ClientTimeout(total=timeout, connect=connect_timeout)
+        self.connections = connections
+        self.host_connections = host_connections
+        self.dns_ttl = dns_ttl
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_failures = breaker_failures
+        self.probe_interval = probe_interval
+        self.max_hosts = max_hosts
+        self.hosts = OrderedDict()  # Hostnames to HostHealth, least recently used first
+        self.session = None
+
+    async def open(self):
+        if self.session and not self.session.closed:
+            return
+        connector = TCPConnector(limit=self.connections, limit_per_host=self.host_connections,
+                                 ttl_dns_cache=self.dns_ttl)
+        self.session = ClientSession(connector=connector, timeout=self.timeout, headers={"User-Agent": "Ona Agent"})
+
+    async def close(self):
+        for health in self.hosts.values():
+            if health.probe:
+                health.probe.cancel()
+        if self.session:
+            await self.session.close()
+
+    async def fetch(self, method, url, handle, **kwargs):
+        '''Make a request and return what the coroutine handle returns for the response. Idempotent requests are
+        retried with jittered exponential backoff after connection errors, timeouts and 5xx or 429 responses.
+        Raises HostUnavailable while the host's breaker is open, without making a request.'''
+        host = urlsplit(url).hostname
+        health = self.get_health(host)
+        if health.open:
+            raise HostUnavailable(host)
+        attempts = self.retries + 1 if method.upper() in self.idempotent else 1
+        for attempt in range(attempts):
+            start = monotonic()
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    if (response.status >= 500 or response.status == 429) and attempt + 1 < attempts:
+                        raise RetryableStatus()
+                    if response.status < 500:
+                        health.success(monotonic() - start)
+                    else:
+                        self.fail(health, method, url, kwargs)
+                    return await handle(response)
+            except (asyncio.TimeoutError, ClientConnectionError, RetryableStatus):
+                self.fail(health, method, url, kwargs)
+                if health.open:
+                    raise HostUnavailable(host)
+                if attempt + 1 == attempts:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def get_health(self, host):
+        health = self.hosts.get(host)
+        if health is None:
+            health = self.hosts[host] = HostHealth()
+            while len(self.hosts) > self.max_hosts:
+                _, evicted = self.hosts.popitem(last=False)
+                if evicted.probe:
+                    evicted.probe.cancel()
+        self.hosts.move_to_end(host)
+        return health
+
+    def fail(self, health, method, url, kwargs):
+        health.failure()
+        # Only the query and headers are kept for the probe, so it never resends a request body
+        health.last_failure = (method if method.upper() in self.idempotent else "HEAD", url,
+                               {key: kwargs[key] for key in ("params", "headers") if key in kwargs})
+        if health.consecutive_failures >= self.breaker_failures and not health.open:
+            health.probe = asyncio.ensure_future(self.probe(health))
+
+    async def probe(self, health):
+        '''Retry the endpoint that last failed on an unhealthy host every probe_interval seconds,
+        and close the host's breaker once it responds.'''
+        try:
+            while True:
+                await asyncio.sleep(self.probe_interval)
+                method, url, kwargs = health.last_failure
+                try:
+                    async with self.session.request(method, url, **kwargs) as response:
+                        if response.status < 500 and response.status != 429:
+                            break
+                except (asyncio.TimeoutError, ClientError):
+                    pass
+                except Exception as e:  # The stored request itself is broken, so stop probing with it
+                    print(f"{type(e).__name__} while probing {url}: {e}")
+                    break
+            health.consecutive_failures = 0
+        finally:
+            health.probe = None
+
+    def stats(self):
+        return {host: health for host, health in sorted(self.hosts.items(), key=lambda item: -item[1].requests)}
+
+
+class OnaResponseCache:
+    '''Responses from external APIs, kept for a time-to-live that depends on the endpoint. Keys are normalized,
+    so the same query typed differently is only fetched once, and identical requests in flight share one fetch.
+    The least recently used responses are dropped past maxsize.'''
+
+    def __init__(self, maxsize, ttls):
+        self.maxsize = maxsize
+        self.ttls = ttls    # Endpoint names to seconds
+        self.entries = OrderedDict()    # Keys to (expiry time, response)
+        self.loading = {}
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(endpoint, url, params):
+        params = sorted((str(key), " ".join(str(value).split()).casefold()) for key, value in (params or {}).items())
+        return endpoint, url, tuple(params)
+
+    async def get(self, key, fetch):
+        '''Return the cached response for the key, or await fetch() for it. Errors aren't cached.'''
+        entry = self.entries.get(key)
+        if entry and entry[0] > monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if key not in self.loading:
+            self.misses += 1
+            self.loading[key] = asyncio.ensure_future(self.load(key, fetch))
+            self.loading[key].add_done_callback(lambda _: self.loading.pop(key, None))
+        return await asyncio.shield(self.loading[key])
+
+    async def load(self, key, fetch):
+        response = await fetch()
+        self.entries[key] = (monotonic() + self.ttls.get(key[0], 0), response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return response
@@ -0,0 +1,56 @@
+import os
+import random
+import itertools
+from PIL import Image, ImageDraw
+from io import BytesIO
+from . import layout
+
+
+class OnaWelcome:
+    '''Renders welcome banners. Every template, font and the avatar mask are loaded once by each image worker,
+    so a render only copies a template and draws the member's text and avatar onto it.'''
+
+    top_text_pos, bot_text_pos = (670, 170), (375, 350)
+    top_text_width, top_font_size, bot_font_size = 620, 80, 55
+    avatar_pos, avatar_size = (20, 150), 165
+    white = (255, 255, 255, 255)
+    blue = (15, 90, 170, 255)
+
+    def __init__(self, resources):
+        directory = resources["welcomes"]
+        self.templates = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".png"):
+                with Image.open(os.path.join(directory, filename)) as template:
+                    self.templates.append(template.convert("RGBA"))     # Decode now rather than on first use
+        self.font = resources["tenshi_font"]
+        self.bot_font = layout.get_font(self.font, self.bot_font_size)
+        self.mask = Image.new("L", (self.avatar_size, self.avatar_size), 0)
+        ImageDraw.Draw(self.mask).ellipse((0, 0, self.avatar_size, self.avatar_size), fill=255)
+
+    def render(self, top_text, bot_text, avatar):
+        '''Draw the text and avatar (as PNG bytes) onto a random template. Returns a PNG in a BytesIO.'''
+        welcome = random.choice(self.templates).copy()
+        draw = ImageDraw.Draw(welcome)
+        # Long names are drawn smaller, so they stay on the banner
+        top_font = layout.fit_text(max(top_text.splitlines(), key=len), self.font, self.top_text_width,
+                                   self.top_font_size * 2, max_size=self.top_font_size)[0]
+        top_text_x, top_text_y = self.top_text_pos
+        top_text_x -= draw.multiline_textsize(top_text, font=top_font)[0] // 2
+        bot_text_x, bot_text_y = self.bot_text_pos
+        for x_offset, y_offset in itertools.product((-2, 2), (-2, 2)):      # Draw the outline around the text
+            draw.multiline_text((top_text_x + x_offset, top_text_y + y_offset), top_text,
+                                align="center", font=top_font, fill=self.white)
+            draw.multiline_text((bot_text_x + x_offset, bot_text_y + y_offset), bot_text,
+                                align="center", font=self.bot_font, fill=self.white)
+        draw.multiline_text((top_text_x, top_text_y), top_text,    # Draw the top text and bottom text
+                            align="center", font=top_font, fill=self.blue)
+        draw.multiline_text((bot_text_x, bot_text_y), bot_text,
+                            align="center", font=self.bot_font, fill=self.blue)
+        avi = Image.open(BytesIO(avatar)).convert("RGBA").resize((self.avatar_size, self.avatar_size))
+        avi.putalpha(self.mask)
+        welcome.alpha_composite(avi, self.avatar_pos)
+        welcome_image = BytesIO()
+        welcome.save(welcome_image, format="PNG")
+        welcome_image.seek(0)
+        return welcome_image